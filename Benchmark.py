@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+'''Loopback benchmark of the Transfer pipeline.
+
+Generates synthetic trees, then archives, serves, downloads and extracts
+each of them over 127.0.0.1 in this process, also as a stream and as
+native frames, then sends the large files again as deltas after an edit.
+It reports the throughput and peak memory of every phase
+as a table and as JSON.
+
+python Benchmark.py [--scale 1.0] [--cases tiny,huge,media,deep]
+					[--profile fast] [--segments 0] [--json result.json]
+'''
+from __future__ import print_function, division
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Transfer keeps its working directory under HOME, use a scratch one
+work_dir = tempfile.mkdtemp(prefix='transfer-bench-')
+os.environ['HOME'] = work_dir
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Transfer  # noqa: E402
+
+
+class Memory_Sampler(object):
+	'''Peak resident size while it runs, sampled from /proc/self/statm'''
+	interval = 0.01
+
+	def __init__(self):
+		self.peak = 0
+		self.stopped = threading.Event()
+		try:
+			self.page_size = os.sysconf('SC_PAGE_SIZE')
+		except (AttributeError, ValueError):
+			self.page_size = 4096
+
+	def rss(self):
+		try:
+			with open('/proc/self/statm') as f:
+				return int(f.read().split()[1]) * self.page_size
+		except (IOError, IndexError, ValueError):
+			import resource
+			return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+	def run(self):
+		while True:
+			self.peak = max(self.peak, self.rss())
+			if self.stopped.wait(self.interval):
+				break
+
+	def __enter__(self):
+		self.peak = self.rss()
+		self.thread = threading.Thread(target=self.run, name='Memory_Sampler')
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def __exit__(self, *args):
+		self.stopped.set()
+		self.thread.join()
+		self.peak = max(self.peak, self.rss())
+
+
+def write_text_file(path, size, rand):
+	words = [b'transfer', b'archive', b'pythonista', b'receiver', b'chunk',
+				b'server', b'stream', b'zip', b'\n', b'delta']
+	data = b' '.join(rand.choice(words) for _ in range(size // 6 + 1))
+	with open(path, 'wb') as f:
+		f.write(data[:size])
+
+
+def write_random_file(path, size):
+	with open(path, 'wb') as f:
+		while size > 0:
+			f.write(os.urandom(min(size, 1024 * 1024)))
+			size -= 1024 * 1024
+
+
+def make_tiny(root, scale, rand):
+	'''many tiny text files'''
+	for i in range(int(5000 * scale)):
+		dir_path = os.path.join(root, 'dir{}'.format(i // 500))
+		if not os.path.isdir(dir_path):
+			os.makedirs(dir_path)
+		write_text_file(os.path.join(dir_path, 'file{}.txt'.format(i)),
+						rand.randint(100, 2000), rand)
+
+
+def make_huge(root, scale, rand):
+	'''a few huge compressible files'''
+	os.makedirs(root)
+	for i in range(2):
+		path = os.path.join(root, 'huge{}.log'.format(i))
+		with open(path, 'wb') as f:
+			block = b''.join(b'%08d transfer log line with some payload\n' % n
+								for n in range(20000))
+			for _ in range(int(64 * 1024 * 1024 * scale) // len(block) + 1):
+				f.write(block)
+
+
+def make_media(root, scale, rand):
+	'''incompressible media files'''
+	os.makedirs(root)
+	for i in range(int(20 * scale) or 1):
+		write_random_file(os.path.join(root, 'photo{}.jpg'.format(i)),
+							4 * 1024 * 1024)
+
+
+def make_deep(root, scale, rand):
+	'''a deep hierarchy of small files'''
+	for i in range(int(1000 * scale) or 1):
+		parts = ['level{}'.format(rand.randint(0, 2)) for _ in range(12)]
+		dir_path = os.path.join(root, *parts[:rand.randint(1, 12)])
+		if not os.path.isdir(dir_path):
+			os.makedirs(dir_path)
+		write_text_file(os.path.join(dir_path, 'leaf{}.py'.format(i)),
+						rand.randint(200, 8000), rand)
+
+
+cases = {'tiny': make_tiny, 'huge': make_huge, 'media': make_media,
+			'deep': make_deep}
+
+
+def serve(transfer):
+	'''Start a Transfer_Server on a free loopback port'''
+	server = Transfer.Transfer_Server(('127.0.0.1', 0), transfer)
+	thread = threading.Thread(target=server.serve_forever, name='server')
+	thread.daemon = True
+	thread.start()
+	url = 'http://127.0.0.1:{}/{}'.format(server.server_address[1],
+											transfer.url_path())
+	return server, thread, url
+
+
+def measure(results, case, phase, func, size=None, files=None):
+	with Memory_Sampler() as memory:
+		start = time.time()
+		value = func()
+		seconds = time.time() - start
+	result = {'case': case, 'phase': phase, 'seconds': round(seconds, 3),
+				'bytes': size, 'files': files, 'peak_rss': memory.peak}
+	if size:
+		result['throughput'] = int(size / max(seconds, 0.001))
+	results.append(result)
+	return value
+
+
+def tree_stats(root):
+	files = size = 0
+	for dir_path, dir_names, file_names in os.walk(root):
+		for name in file_names:
+			files += 1
+			size += os.path.getsize(os.path.join(dir_path, name))
+	return files, size
+
+
+def insert_bytes(root, rand):
+	'''Insert a few bytes in the middle of the files of at least
+	dedup_min_size, returns their paths'''
+	paths = []
+	for dir_path, dir_names, file_names in os.walk(root):
+		for name in file_names:
+			path = os.path.join(dir_path, name)
+			with open(path, 'rb') as f:
+				data = f.read()
+			if len(data) >= Transfer.dedup_min_size:
+				middle = rand.randint(0, len(data))
+				with open(path, 'wb') as f:
+					f.write(data[:middle] + b'inserted' + data[middle:])
+				paths.append(path)
+	return paths
+
+
+def member_name(path, files):
+	'''The archive member name of path in a tree of files files, a lone
+	file is archived under its basename'''
+	if files == 1 and not Transfer.pythonista:
+		return os.path.basename(path)
+	return Transfer.normalize_arcname(path)
+
+
+def extracted_root(extract_path, root, files):
+	'''Where the copy of root is after extracting to extract_path'''
+	if files == 1 and not Transfer.pythonista:
+		return extract_path
+	return Transfer.member_path(extract_path, root)
+
+
+def compare_trees(a, b):
+	for dir_path, dir_names, file_names in os.walk(a):
+		for name in file_names:
+			path = os.path.join(dir_path, name)
+			other = os.path.join(b, os.path.relpath(path, a))
+			with open(path, 'rb') as f1, open(other, 'rb') as f2:
+				if f1.read() != f2.read():
+					raise AssertionError('{} differs after the transfer'.format(path))
+
+
+def run_case(name, scale, profile, segments, results):
+	rand = random.Random(name)
+	root = os.path.join(work_dir, 'src', name)
+	cases[name](root, scale, rand)
+	files, raw_size = tree_stats(root)
+	transfer = Transfer.Transfer(Transfer.main_dir, 0)
+	comment = json.dumps({'sender': 'Benchmark'})
+
+	# file mode: archive, serve the archive, download it, extract it
+	measure(results, name, 'archive',
+			lambda: Transfer.archiver([root], True, transfer.send_path, comment,
+										profile),
+			raw_size, files)
+	archive_size = os.path.getsize(transfer.send_path)
+	results[-1]['ratio'] = round(archive_size / max(raw_size, 1), 3)
+	server, thread, url = serve(transfer)
+	download_path = os.path.join(work_dir, 'download.zip')
+	measure(results, name, 'download',
+			lambda: Transfer.downloader(url, download_path, progress=False,
+										segments=segments),
+			archive_size)
+	thread.join()  # the server stops once the archive was delivered
+	server.server_close()
+	extract_path = os.path.join(work_dir, 'extract')
+	measure(results, name, 'extract',
+			lambda: Transfer.extract_zip(download_path, extract_path),
+			raw_size, files)
+	compare_trees(root, extracted_root(extract_path, root, files))
+	for path in (transfer.send_path, download_path, extract_path):
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		elif os.path.exists(path):
+			os.remove(path)
+
+	# stream mode: archived while served, extracted while downloaded
+	if Transfer.zip_stream_supported:
+		transfer.stream = True
+		transfer.stream_args = ([root], comment, profile)
+		server, thread, url = serve(transfer)
+		os.makedirs(extract_path)
+		measure(results, name, 'stream',
+				lambda: Transfer.stream_extract(url, extract_path, progress=False),
+				raw_size, files)
+		thread.join()
+		server.server_close()
+		compare_trees(root, extracted_root(extract_path, root, files))
+		shutil.rmtree(extract_path)
+
+		# the same stream as frames of the native protocol
+		server, thread, url = serve(transfer)
+		os.makedirs(extract_path)
+		received = {}
+
+		def count(done, total, speed):
+			received['bytes'] = done
+
+		options = json.dumps({'solid': Transfer.solid_codecs})
+		measure(results, name, 'native',
+				lambda: Transfer.native_extract(url + '?native', extract_path,
+												progress=False, data=options,
+												callback=count),
+				raw_size, files)
+		results[-1]['ratio'] = round(received['bytes'] / max(raw_size, 1), 3)
+		thread.join()
+		server.server_close()
+		compare_trees(root, extracted_root(extract_path, root, files))
+
+		# deltas of the large files against the copies just received, after
+		# bytes were inserted, only the chunks around the edit should be sent
+		edited = insert_bytes(root, rand) if Transfer.dedup_supported else []
+		if edited:
+			bases = {}
+			for path in edited:
+				arcname = member_name(path, files)
+				old_path = Transfer.member_path(extract_path, arcname)
+				bases[arcname] = (old_path, Transfer.chunk_signature(
+										Transfer.file_chunks(old_path)[0]))
+			options = json.dumps({'only': sorted(bases),
+									'signatures': dict((arcname, sorted(base[1]))
+														for arcname, base in bases.items())})
+			server, thread, url = serve(transfer)
+			delta_path = os.path.join(work_dir, 'delta')
+			os.makedirs(delta_path)
+			edited_size = sum(os.path.getsize(path) for path in edited)
+			measure(results, name, 'delta',
+					lambda: Transfer.stream_extract(url + '?archive', delta_path,
+													progress=False, data=options,
+													bases=bases, callback=count),
+					edited_size, len(edited))
+			results[-1]['ratio'] = round(received['bytes'] / max(edited_size, 1), 3)
+			thread.join()
+			server.server_close()
+			for path in edited:
+				other = Transfer.member_path(delta_path, member_name(path, files))
+				with open(path, 'rb') as f1, open(other, 'rb') as f2:
+					if f1.read() != f2.read():
+						raise AssertionError('{} differs after the delta'.format(path))
+			shutil.rmtree(delta_path)
+		shutil.rmtree(extract_path)
+	shutil.rmtree(root)
+
+
+def print_table(results):
+	header = ('case', 'phase', 'seconds', 'MB/s', 'files', 'MB', 'peak MB')
+	rows = [header]
+	for result in results:
+		rows.append((result['case'], result['phase'], '{:.3f}'.format(result['seconds']),
+						'{:.1f}'.format(result.get('throughput', 0) / 1024 / 1024),
+						str(result['files'] or ''),
+						'{:.1f}'.format((result['bytes'] or 0) / 1024 / 1024),
+						'{:.1f}'.format(result['peak_rss'] / 1024 / 1024)))
+	widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+	for row in rows:
+		print('  '.join(x.rjust(w) if i > 1 else x.ljust(w)
+						for i, (x, w) in enumerate(zip(row, widths))))
+
+
+def main(args):
+	scale = float(Transfer.pop_option(args, '--scale', 1.0))
+	names = Transfer.pop_option(args, '--cases', 'tiny,huge,media,deep').split(',')
+	profile = Transfer.pop_option(args, '--profile', 'fast')
+	segments = int(Transfer.pop_option(args, '--segments', 0))
+	json_path = Transfer.pop_option(args, '--json')
+	results = []
+	try:
+		for name in names:
+			print('Running {}.....'.format(name))
+			run_case(name, scale, profile, segments, results)
+	finally:
+		shutil.rmtree(work_dir, True)
+	print('')
+	print_table(results)
+	report = {'python': sys.version.split()[0], 'scale': scale, 'profile': profile,
+				'results': results}
+	if json_path:
+		with open(json_path, 'w') as f:
+			json.dump(report, f, indent=1)
+		print('\nSaved {}'.format(json_path))
+	else:
+		print(json.dumps(report))
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -12,26 +12,45 @@ Adding shortcuts makes it easy to use.
 See image files in https://github.com/nekotaroneko/Transfer
 '''
 
+import collections
 import datetime
-import glob
+import errno
+import fnmatch
+import hashlib
+import io
+import itertools
 import json
+import mmap
 import os
 import platform
+import random
 import re
 import requests
 import shutil
 import socket
+import stat
+import struct
 import sys
 import threading
 import time
 import zipfile
-from six.moves import input, BaseHTTPServer, SimpleHTTPServer
+import zlib
+from six.moves import input, queue, BaseHTTPServer, SimpleHTTPServer, socketserver
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 
 def is_pythonista():
 	return 'Pythonista' in sys.executable
 
 pythonista = is_pythonista()
+# zipfile can only write to unseekable streams (data descriptors) on 3.5+
+zip_stream_supported = sys.version_info >= (3, 5)
+# recipe members are written with ZipFile.open(zinfo, 'w')
+dedup_supported = sys.version_info >= (3, 6)
+try:
+	import lzma
+except ImportError:  # Python 2
+	lzma = None
 
 if pythonista:
 	import console
@@ -368,6 +387,22 @@ def human_size(size_bytes, no_suffixs=False):
 	return formatted_size if no_suffixs else "%s %s" % (formatted_size, suffix)
 
 
+def parse_size(value):
+	'''Bytes of a size like "500K", "10M" or "1.5G", None for nothing.
+	Raises ValueError for anything else and for sizes below one byte.'''
+	if not value:
+		return None
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+	number = str(value).strip().upper().rstrip('B')
+	unit = 1
+	if number[-1:] in units:
+		number, unit = number[:-1], units[number[-1]]
+	size = float(number) * unit
+	if not 1 <= size < float('inf'):  # also rejects nan
+		raise ValueError('Not a size: {}'.format(value))
+	return int(size)
+
+
 # ----------------------Main Code--------------------
 
 class Transfer(object):
@@ -377,88 +412,297 @@ class Transfer(object):
 		self.main_dir = main_dir
 		self.send_path = to_abs_path(main_dir, "SendFile.zip")
 		self.receive_path = to_abs_path(main_dir, "ReceiveFile.zip")
+		self.peers_path = to_abs_path(main_dir, "peers.json")  # recent senders
+		self.receivers_path = to_abs_path(main_dir, "receivers.json")
+		self.hashes_path = to_abs_path(main_dir, "hashes.json")
+		# like hashes_path, [size, mtime, file digest, chunks], see cached_chunks()
+		self.chunk_indexes_path = to_abs_path(main_dir, "chunk_indexes.json")
+		self.stats_path = to_abs_path(main_dir, "stats.jsonl")
+		self.stats = None  # Stats of the running send() or receive()
 		self.comment_dict['send_path'] = self.send_path  # to multiply file size
 		self.comment_dict['receive_path'] = self.receive_path # to multiply file size
 		if os.path.isfile(self.send_path):
 			os.remove(self.send_path)
 		system = platform.system()
 		self.system = 'Pythonista' if pythonista else system
-
-	def send(self, file_list):
+		self.stream = False  # archive is produced while serving the GET
+		self.segments = 0  # download connections, 0 tunes it from the speed
+		# include/exclude glob patterns and dotfiles for walk_files()
+		self.walk_options = {'include': None, 'exclude': None, 'hidden': False}
+		self.stream_args = None
+		self.sync_options = None  # {'delete': bool} while sync() serves
+		# large files are sent as chunks the receiver does not hold yet
+		self.dedup = False
+		self.chunk_store = Chunk_Store(to_abs_path(main_dir, "chunks"))
+		self.chunk_indexes = None  # loaded on first use, see chunk_index()
+		self.chunk_lock = threading.Lock()
+		# stream mode also offers the frames of write_frames() to receivers
+		self.native = True
+		# bytes per second for all receivers together and for each receiver,
+		# None is unlimited; the serving Transfer_Server follows changes
+		self.rate_limit = None
+		self.client_rate_limit = None
+
+	def send(self, file_list, stream=False, receivers=1, deadline=None,
+				profile='fast'):
+		'''Serve file_list until `receivers` clients have received it or
+		`deadline` seconds have passed. profile is "fast" or "small".'''
+		if profile not in compression_profiles:
+			# checked here, a stream archive is only written inside a request
+			raise ValueError('Unknown profile {}'.format(profile))
 		if pythonista:
 			console.set_idle_timer_disabled(True)
-		print('Archiving files.....')
 
 		self.comment_dict['sender'] = self.system
 		comment_str = json.dumps(self.comment_dict)
-		archiver(file_list, True, self.send_path, comment_str)
-
-		self.start_server()
+		stats = self.stats = Stats('send', self.system)
+		if stream and not zip_stream_supported:
+			print('Streaming needs Python 3.5+, archiving first')
+			stream = False
+			self.sync_options = None
+		if stream and receivers > 1:
+			# archive once and serve the same file to every receiver
+			stream = False
+		if self.dedup and not (stream and dedup_supported):
+			print('Deduplication needs streaming and Python 3.6+, sending everything')
+			self.dedup = False
+		self.stream = stream
+		if stream:
+			self.stream_args = (file_list, comment_str, profile)
+			size = None
+			# one walk for the stats and the file count of the beacon
+			stats.start('walk')
+			file_count = raw_size = 0
+			for path, st, arcname in walk_files(file_list, **self.walk_options):
+				file_count += 1
+				raw_size += st.st_size if stat.S_ISREG(st.st_mode) else 0
+			stats.stop('walk', files=file_count, raw_bytes=raw_size)
+		else:
+			print('Archiving files.....')
+			stats.start('archive')
+			archiver(file_list, True, self.send_path, comment_str, profile,
+						**self.walk_options)
+			size = os.path.getsize(self.send_path)
+			with zipfile.ZipFile(self.send_path) as zf:
+				files = [x for x in zf.infolist()
+							if x.filename != hashes_member and not x.filename.endswith('/')]
+			file_count = len(files)
+			raw_size = sum(x.file_size for x in files)
+			stats.stop('archive', files=file_count, bytes=raw_size, archive_bytes=size,
+						ratio=round(size / float(raw_size), 3) if raw_size else None)
+		self.beacon_info = {'service': 'Transfer', 'ip': port_scan.current_ip,
+							'port': self.port, 'path': self.url_path(), 'size': size,
+							'files': file_count, 'sender': self.system}
+
+		stats.start('serve')
+		server = self.start_server(receivers, deadline)
+		if server:
+			sent = sum(x['sent'] for x in server.clients.values())
+			stats.stop('serve', bytes=sent, receivers=server.completed,
+						clients=len(set(x['ip'] for x in server.clients.values())),
+						ratio=round(sent / float(raw_size), 3) if raw_size else None,
+						rate_limit=self.rate_limit, client_rate_limit=self.client_rate_limit)
+		stats.save(self.stats_path)
+		self.stats = None
 		if self.system == 'Windows':
 			os.system('pause')
 
-	def receive(self, wait_time, show_text=True):
+	def receive(self, wait_time, show_text=True, stream=None, standing=False):
+		'''Find a sender and receive from it. A standing receiver waits for
+		beacons instead of polling, see wait_sender().'''
 		if pythonista:
 			console.set_idle_timer_disabled(True)
 		main_dir = self.main_dir
 
-		if os.path.isfile(self.receive_path):
-			os.remove(self.receive_path)
+		# a partial ReceiveFile.zip is kept for downloader() to resume
+		rel_path = self.url_path()
+		peers = self.load_peers()
+		stats = self.stats = Stats('receive', self.system)
+		stats.start('discovery')
+		sender_port = self.port
 		try:
-			while True:
-				if show_text:
-					print('Detecting Server.....')
-				result = port_scan.scan()
-				if result:
-					IP = result[0]
-					break
-				if show_text:
-					print('waiting for {}s'.format(wait_time))
-				time.sleep(wait_time)
+			if standing:
+				IP, sender_port, rel_path, method = self.wait_sender(rel_path, peers)
+			else:
+				while True:
+					if show_text:
+						print('Detecting Server.....')
+					# recent senders answer a single connect
+					result = port_scan.probe(peers, first=True) if peers else []
+					if not result:
+						# a beacon arrives as soon as a sender is ready, the TCP sweep
+						# only finds senders without one
+						info = listen_beacon(self.port, wait_time)
+						if info:
+							IP = info['ip']
+							sender_port = info.get('port', sender_port)
+							rel_path = info.get('path', rel_path)
+							method = 'beacon'
+							break
+						result = port_scan.scan(first=True)
+						method = 'scan'
+					else:
+						method = 'peer'
+					if result:
+						IP = result[0]
+						break
+					if show_text:
+						print('waiting for {}s'.format(wait_time))
 		except KeyboardInterrupt:
 			raise KeyboardInterrupt
+		stats.stop('discovery', method=method, sender=IP)
 
 		d = datetime.datetime.today().strftime("%Y-%m-%d %H-%M-%S")
 		to_extract_path = to_abs_path(main_dir, d)
 
 		print('Detected!!\nServer IP is ' + IP)
-		rel_path = os.path.relpath(self.send_path, to_abs_path())
-		rel_path = rel_path.replace("\\", "/")  # for windows
-		target_url = 'http://{}:{}/{}'.format(IP, port, rel_path)
-		downloader(target_url, self.receive_path)
-		if os.path.exists(self.receive_path):
-			if pythonista:
-				console.hud_alert('Transfer Completed!!')
+		target_url = 'http://{}:{}/{}'.format(IP, sender_port, rel_path)
+		head = requests.head(target_url)
+		if stream is None:
+			# extract while downloading when the sender streams its archive
+			stream = head.headers.get('X-Transfer-Mode') == 'stream'
+		sync = bool(head.headers.get('X-Transfer-Sync'))
+		if sync:
+			stream = True
+		# the files of a Pythonista sender can be written to their original
+		# paths, the only local copy a sync can compare with
+		place = stream and pythonista and \
+			head.headers.get('X-Transfer-Sender') == 'Pythonista' and self.ask_placement()
+		# posted to "?archive" to have only what is missing here sent
+		options = {}
+		if sync and place:
+			info = requests.get(target_url + '?info').json()
+			print('Comparing with the local copy.....')
+			options['manifest'] = self.manifest(info['roots'], info['walk_options'])
+		elif sync:
+			print('Not syncing, the files are not moved to their original paths')
+		bases = None
+		if options and dedup_supported:
+			# large changed files come as deltas against the copies here
+			plan = requests.post(target_url + '?plan', data=json.dumps(options)).json()
+			if plan['hash'] == new_hash().name and plan['changed']:
+				print('Signing {} changed files.....'.format(len(plan['changed'])))
+				bases = self.delta_bases(plan['changed'], plan['unindexed'], stats)
+				options['signatures'] = dict((arcname, sorted(base[1]))
+											for arcname, base in bases.items())
+		store = None
+		if head.headers.get('X-Transfer-Dedup') and dedup_supported:
+			index = requests.get(target_url + '?chunks').json()
+			if index['hash'] == new_hash().name:
+				store = self.chunk_store
+				options['have'] = [x for x in index['digests'] if store.has(x)]
+				print('{} of {} chunks are already here'.format(len(options['have']),
+																len(index['digests'])))
+			stream = True
+		receive_comment_dict = None
+		received = {'bytes': 0}
+		# the sender waits for an acknowledgement so bad files can be fetched again
+		verify = bool(head.headers.get('X-Transfer-Verify'))
+		if verify:
+			requests.get(target_url + '?verify')
+		verifier = Verifier()
+
+		def count(done, total, speed):
+			received['bytes'] = done
+
+		# replacing existing files is asked up front from the list of what
+		# will be sent
+		placement = None
+		if place:
+			names = requests.post(target_url + '?files', data=json.dumps(options)).json()
+			placement = self.placement(names['files'])
+
+		if stream:
 			if not os.path.isdir(to_extract_path):
 				os.makedirs(to_extract_path)
-			zip = zipfile.ZipFile(self.receive_path)
-			receive_comment_dict = json.loads(zip.comment.decode('utf-8'))
-			print('\nExtracting.....')
-			sender = receive_comment_dict['sender']
-			for _ in zip.infolist():
-				decoding = 'shift-jis' if sender == 'Windows' else 'utf-8'
-				_.filename = _.filename.encode('utf-8').decode(decoding, 'replace')
-				try:
-					zip.extract(_, to_extract_path)
-				except:
-					new_filename = []
-					sep = '//' if sender == 'Windows' else '/'
-					for split in _.filename.split(sep):
-						_split = re.sub(r'[\\|/|:|?|"|<|>|\|]', '-', split).strip()
-						new_filename.append(_split)
-					new_filename = sep.join(new_filename)
-					_.filename = new_filename
-
-					try:
-						zip.extract(_, to_extract_path)
-					except Exception as e:
-						print('Error {}'.format(_.filename))
-						print(e)
-					else:
-						print('Renamed {}'.format(_.filename))
-
-			zip.close()
-			os.remove(self.receive_path)
+			print('Downloading and extracting.....')
+			stats.start('download_extract')
+			# the framed protocol when the sender offers it, chunk recipes need zip
+			native = self.native and store is None and bases is None and \
+				head.headers.get('X-Transfer-Native') == str(native_version)
+			if native:
+				# the codecs this end can unpack solid blocks of small files with
+				data = json.dumps(dict(options, solid=solid_codecs))
+				receive_comment_dict = native_extract(target_url + '?native',
+														to_extract_path, data=data,
+														callback=count, verifier=verifier,
+														placement=placement)
+			elif options:
+				receive_comment_dict = stream_extract(target_url + '?archive',
+														to_extract_path, data=json.dumps(options),
+														store=store, bases=bases, callback=count,
+														verifier=verifier, placement=placement)
+			else:
+				receive_comment_dict = stream_extract(target_url, to_extract_path,
+														callback=count, verifier=verifier,
+														placement=placement)
+			file_count, size = tree_size(to_extract_path)
+			stats.stop('download_extract', bytes=received['bytes'], files=file_count,
+						extracted_bytes=size, dedup=store is not None,
+						deltas=len(bases) if bases else 0,
+						placed=len(placement.placed) if placement else 0,
+						protocol='native' if native else 'zip')
+			if store:
+				store.evict()
+		else:
+			stats.start('download')
+			downloader(target_url, self.receive_path, segments=self.segments,
+						callback=count)
+			stats.stop('download', bytes=received['bytes'])
+			if os.path.exists(self.receive_path):
+				if not os.path.isdir(to_extract_path):
+					os.makedirs(to_extract_path)
+				if pythonista:
+					with zipfile.ZipFile(self.receive_path) as zf:
+						comment_dict = json.loads(zf.comment.decode('utf-8'))
+						names = [normalize_arcname(x) for x in zf.namelist()
+									if not x.endswith('/') and x != hashes_member]
+					if comment_dict['sender'] == 'Pythonista' and \
+							'share_text' not in comment_dict and self.ask_placement():
+						placement = self.placement(names)
+				print('\nExtracting.....')
+				stats.start('extract')
+				receive_comment_dict = extract_zip(self.receive_path, to_extract_path,
+													verifier, placement=placement)
+				file_count, size = tree_size(to_extract_path)
+				stats.stop('extract', bytes=size, files=file_count,
+							ratio=round(received['bytes'] / float(size), 3) if size else None,
+							placed=len(placement.placed) if placement else 0)
+				os.remove(self.receive_path)
+		if receive_comment_dict is not None and verifier.expected is not None:
+			stats.start('verify')
+			bad = verifier.bad()
+			refetched = len(bad)
+			for attempt in range(2):
+				if not bad or not verify:
+					break
+				print('Fetching {} files again.....'.format(len(bad)))
+				if stream:
+					retry = Verifier()
+					stream_extract(target_url + '?archive', to_extract_path, False,
+									data=json.dumps({'only': bad}), verifier=retry,
+									placement=placement)
+				else:
+					retry = refetch_members(target_url, bad, to_extract_path,
+											receive_comment_dict['sender'], verifier,
+											placement)
+				bad = retry.bad()
+			stats.stop('verify', files=len(verifier.digests), refetched=refetched,
+						bad=len(bad))
+			if bad:
+				msg = 'Following files are corrupted.\n{}'.format('\n'.join(bad))
+				if pythonista:
+					console.alert("Transfer", msg, "OK", hide_cancel_button=True)
+				else:
+					print(msg)
+			else:
+				print('Verified {} files'.format(len(verifier.digests)))
+		if verify:
+			requests.get(target_url + '?ack')
+		if receive_comment_dict is not None:
+			self.add_peer(IP)
+			if pythonista:
+				console.hud_alert('Transfer Completed!!')
 			if 'share_text' in receive_comment_dict:
 				share_text = receive_comment_dict['share_text']
 				if pythonista:
@@ -472,53 +716,32 @@ class Transfer(object):
 					print('Share text \n"\n{}\n"'.format(share_text))
 				removeEmptyFolders(to_extract_path, True)
 
-			elif pythonista and receive_comment_dict['sender'] == 'Pythonista':
-				msg = "Sender is Pythonista\nMove to original path?"
-				if console.alert("Transfer", msg, "No", "Yes",
-									hide_cancel_button=True) == 2:
-					print('-----Detailed Log-----\n')
-					file_list = [(to_abs_path(os.path.relpath(x, to_extract_path)), x)
-									for x in return_all_file(to_extract_path)]
-					total_file_list = []  # file not dir
-
-					# print(file_list
-					replace_list = []
-					for original_path, transfer_path in file_list:
+			elif placement is not None:
+				print('-----Detailed Log-----\n')
+				placed = sorted(set(placement.placed))  # refetched files come twice
+				for path in placed:
+					print('placed {}'.format(os.path.relpath(path, to_abs_path())))
+				for name in sorted(placement.keep):
+					print('kept {} in {}'.format(name, os.path.basename(to_extract_path)))
+
+				deleted = receive_comment_dict.get('deleted')
+				if deleted and console.alert("Transfer", "Following files will be deleted.\n{}".format('\n'.join(deleted)), "No", "OK", hide_cancel_button=True) == 2:
+					for arcname in deleted:
+						original_path = to_abs_path(arcname)
 						if os.path.isfile(original_path):
-							replace_list.append([original_path, transfer_path])
-
-						if os.path.isdir(transfer_path):
-							if not os.path.isdir(original_path):
-								os.makedirs(original_path)
-								fmt = 'dir {} was creadted'
-								print(fmt.format(os.path.relpath(original_path, to_abs_path())))
-						else:
-							if not os.path.isfile(original_path):
-								shutil.move(transfer_path, original_path)
-								fmt = 'moved {} to {}'
-								print(fmt.format(os.path.relpath(transfer_path, to_abs_path()),
-													os.path.relpath(original_path, to_abs_path())))
-								total_file_list.append(original_path)
-
-					if replace_list and console.alert("Transfer", "Following files will be replaced.\n{}".format('\n'.join([os.path.relpath(x, to_abs_path()) for x, y in replace_list])), "No", "OK", hide_cancel_button=True) == 2:
-						for original_path, transfer_path in replace_list:
 							os.remove(original_path)
-							print('{} was removed'.format(os.path.relpath(original_path,
-																			to_abs_path())))
-							shutil.move(transfer_path, original_path)
-							fmt = 'moved {} to {}'
-							print(fmt.format(os.path.relpath(transfer_path, to_abs_path()),
-												os.path.relpath(original_path, to_abs_path())))
-							total_file_list.append(original_path)
-
-					removeEmptyFolders(to_extract_path, True)
-					if len(total_file_list) == 1:
-						ab_file_path = total_file_list[0]
-						re_file_path = os.path.relpath(ab_file_path, to_abs_path())
-						msg = 'Do you want to open {}?'.format(re_file_path)
-						if console.alert("Transfer", msg, "No", "Yes",
-											hide_cancel_button=True) == 2:
-							editor.open_file(ab_file_path, True)
+							print('{} was removed'.format(arcname))
+						else:
+							removeEmptyFolders(original_path, True)
+
+				removeEmptyFolders(to_extract_path, True)
+				if len(placed) == 1:
+					ab_file_path = placed[0]
+					re_file_path = os.path.relpath(ab_file_path, to_abs_path())
+					msg = 'Do you want to open {}?'.format(re_file_path)
+					if console.alert("Transfer", msg, "No", "Yes",
+										hide_cancel_button=True) == 2:
+						editor.open_file(ab_file_path, True)
 			else:
 				msg = 'Sender is {sender}'.format(**receive_comment_dict)
 				if pythonista:
@@ -530,6 +753,8 @@ class Transfer(object):
 					os.system('explorer.exe {}'.format(to_extract_path))
 				elif self.system == 'Linux':
 					os.system('nautilus "{}"'.format(to_extract_path))
+			stats.save(self.stats_path)
+			self.stats = None
 			print('Done!!')
 			if self.system == 'Windows':
 				os.system('pause')
@@ -537,61 +762,472 @@ class Transfer(object):
 			console.alert("Transfer", "{} is not found".format(self.receive_path), "OK",
 																hide_cancel_button=True)
 
-	def start_server(self):
-		def do_GET(self):
-			"""Serve a GET request."""
-			f = self.send_head()
-			if f:
-				try:
-					self.copyfile(f, self.wfile)
-				finally:
-					f.close()
-					t = threading.Thread(target=self.server.shutdown)
-					t.daemon = True
-					t.start()
-					print('File transfer was completed.Server is shutdowning.....')
-
-		def translate_path(self, path):
-			"""Translate a /-separated PATH to the local filename syntax.
-
-			Components that mean special things to the local file system
-			(e.g. drive or directory names) are ignored.  (XXX They should
-			probably be diagnosed.)
-			"""
-			import posixpath
-			from six.moves.urllib_parse import unquote
-			# abandon query parameters
-			path = path.split('?', 1)[0]
-			path = path.split('#', 1)[0]
-			# Don't forget explicit trailing slash when normalizing. Issue17324
-			trailing_slash = path.rstrip().endswith('/')
-			path = posixpath.normpath(unquote(path))
-			words = filter(None, path.split('/'))
-			path = to_abs_path()
-			for word in words:
-				if os.path.dirname(word) or word in (os.curdir, os.pardir):
-					# Ignore components that are not a simple file/directory name
-					continue
-				path = os.path.join(path, word)
-			if trailing_slash:
-				path += '/'
-			return path
+	def wait_sender(self, rel_path, peers):
+		'''Block until a sender shows up. Beacons wake it at once and cost
+		nothing while idle; senders whose broadcasts do not arrive are looked
+		for with a scan after exponentially growing, jittered intervals.
+		Returns (ip, port, url path, method).'''
+		delay = standing_poll_min
+		while True:
+			info = listen_beacon(self.port, delay * random.uniform(0.5, 1.5))
+			if info:
+				return (info['ip'], info.get('port', self.port), info.get('path', rel_path),
+						'beacon')
+			result = port_scan.probe(peers, first=True) if peers else []
+			if result:
+				return result[0], self.port, rel_path, 'peer'
+			result = port_scan.scan(first=True)
+			if result:
+				return result[0], self.port, rel_path, 'scan'
+			delay = min(delay * 2, standing_poll_max)
+
+	def recent_stats(self, count=20):
+		'''The last count records of the stats file'''
+		try:
+			with open(self.stats_path) as f:
+				lines = collections.deque(f, count)
+		except IOError:
+			return []
+		return [json.loads(line) for line in lines if line.strip()]
+
+	def load_peers(self, path=None):
+		'''IPs of recent senders, or of the peers in path like
+		receivers_path, most recent first'''
+		try:
+			with open(path or self.peers_path) as f:
+				peers = json.load(f)
+		except (IOError, ValueError):
+			return []
+		return sorted(peers, key=peers.get, reverse=True)
+
+	def add_peer(self, ip, path=None):
+		path = path or self.peers_path
+		try:
+			with open(path) as f:
+				peers = json.load(f)
+		except (IOError, ValueError):
+			peers = {}
+		peers[ip] = time.time()
+		recent = sorted(peers, key=peers.get, reverse=True)[:8]
+		with open(path, 'w') as f:
+			json.dump(dict((x, peers[x]) for x in recent), f)
+
+	def url_path(self):
+		rel_path = os.path.relpath(self.send_path, to_abs_path())
+		return rel_path.replace("\\", "/")  # for windows
 
+	def start_server(self, receivers=1, deadline=None):
 		print('Starting Server.....')
-		SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET = do_GET
-		SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path = translate_path
 		try:
-			server = BaseHTTPServer.HTTPServer(('', self.port),
-												SimpleHTTPServer.SimpleHTTPRequestHandler)
+			server = Transfer_Server(('', self.port), self, receivers, deadline)
 		except Exception as e:
 			print(e)
 			print('Server has already started')
 		else:
+			if receivers > 1:
+				print('Waiting for {} receivers'.format(receivers))
 			thread = threading.Thread(target=server.serve_forever, name='server')
 			thread.deamon = True
 			thread.start()
+			monitor = threading.Thread(target=server.monitor, name='monitor')
+			monitor.daemon = True
+			monitor.start()
+			beacon = Beacon(self.port, self.beacon_info,
+							self.load_peers(self.receivers_path))
+			beacon.start()
 			thread.join()
-			os.remove(self.send_path)
+			beacon.stop()
+			server.server_close()
+			if os.path.isfile(self.send_path):
+				os.remove(self.send_path)
+			self.stream = False
+			self.stream_args = None
+			return server
+
+	def write_archive(self, fp, manifest=None, have=None, signatures=None,
+						only=None, skip=None, verify=True):
+		'''Archive the pending files straight into fp (stream mode).
+
+		With the manifest of a receiver only new and changed files are
+		archived and the comment lists the files to delete. With have, the
+		chunk digests the receiver holds, large files become recipe members,
+		and so do the files in signatures, {arcname: chunk digests of the
+		receiver's old copy}, which makes them deltas. only limits the archive
+		to those member names, for files that failed verification, and skip
+		leaves out the members a resumed receiver already has. verify adds
+		the hashes_member.
+		'''
+		file_list, comment_str, profile = self.stream_args
+		cache = self.load_hashes() if manifest is not None else None
+		comment_str, select = self.selection(manifest, cache, only, skip)
+		have = set(have) if have is not None and self.dedup else None
+		signatures = signatures or {}
+
+		def held(arcname):
+			base = signatures.get(normalize_arcname(arcname))
+			if base is None:
+				return have
+			return have | set(base) if have else set(base)
+
+		dedup = None
+		if (have is not None or signatures) and dedup_supported:
+			# a receiver with a chunk store keeps the chunks of earlier members,
+			# so copies and renamed files in the tree are sent once
+			dedup = (self.chunk_index, held, set() if have is not None else None)
+		writer = Stream_Writer(fp)
+		archiver(file_list, True, writer, comment_str, profile, select=select,
+					dedup=dedup, verify=verify, **self.walk_options)
+		writer.flush()
+		if cache is not None:
+			self.save_hashes(cache)
+		if dedup:
+			self.save_chunk_indexes()
+
+	def ask_placement(self):
+		'''Whether the files of a Pythonista sender go to their original
+		paths instead of the transfer folder'''
+		msg = "Sender is Pythonista\nMove to original path?"
+		return console.alert("Transfer", msg, "No", "Yes", hide_cancel_button=True) == 2
+
+	def placement(self, names):
+		'''Ask whether the existing files among names, files of a Pythonista
+		sender that go to their original paths, are replaced. Returns a
+		Placement.'''
+		replace_list = [x for x in names if os.path.isfile(to_abs_path(x))]
+		if replace_list and console.alert("Transfer", "Following files will be replaced.\n{}".format('\n'.join(replace_list)), "No", "OK", hide_cancel_button=True) != 2:
+			return Placement(to_abs_path(), replace_list)
+		return Placement(to_abs_path())
+
+	def write_frames(self, fp, manifest=None, only=None, solid=None, skip=None):
+		'''Send the pending files to fp as frames of the native protocol
+		(stream mode), see native_extract(). manifest and only select files
+		like write_archive().
+
+		A manifest frame with the comment and the UTF-8 names comes first.
+		skip leaves out the files a resumed receiver already has.
+		Worker threads then read the files in blocks, compress the blocks
+		that shrink, and queue file, data and end frames, so the blocks of
+		several files share the connection. A close frame ends the stream.
+
+		solid lists the codecs the receiver can read solid blocks with. When
+		the files average below solid_average_size, the small ones are
+		concatenated and compressed together in solid frames instead.
+		'''
+		file_list, comment_str, profile = self.stream_args
+		cache = self.load_hashes() if manifest is not None else None
+		comment_str, select = self.selection(manifest, cache, only, skip)
+		entries = list(walk_files(file_list, **self.walk_options))
+		single = not pythonista and len(entries) == 1
+		files = []
+		dirs = []
+		for path, st, arcname in entries:
+			if single:
+				arcname = os.path.basename(path)
+			if select and not select(path, st, arcname):
+				continue
+			if stat.S_ISDIR(st.st_mode):
+				dirs.append(normalize_arcname(arcname))
+			else:
+				files.append((path, normalize_arcname(arcname), st.st_size))
+		if cache is not None:
+			self.save_hashes(cache)
+		head = {'comment': json.loads(comment_str), 'hash': new_hash().name,
+				'files': [[arcname, size] for path, arcname, size in files],
+				'dirs': dirs}
+		writer = Stream_Writer(fp)
+		write_frame(writer, frame_manifest, json.dumps(head).encode('utf-8'))
+
+		tasks = queue.Queue()
+		codec = solid_codec(solid, profile) if files and \
+			sum(x[2] for x in files) < solid_average_size * len(files) else None
+		block = []
+		block_size = 0
+		for index, entry in enumerate(files):
+			path, arcname, size = entry
+			if codec is None or size > solid_member_limit or \
+					os.path.splitext(path)[1].lower() in stored_extensions:
+				tasks.put((index, entry))
+				continue
+			block.append((index, entry))
+			block_size += size
+			if block_size >= solid_block_size:
+				tasks.put((None, block))
+				block = []
+				block_size = 0
+		if block:
+			tasks.put((None, block))
+		frames = queue.Queue(native_queue_frames)
+		stopped = threading.Event()
+
+		def put(kind, payload):
+			while not stopped.is_set():
+				try:
+					frames.put((kind, payload), timeout=1)
+					return True
+				except queue.Full:
+					pass
+			return False
+
+		def worker():
+			# the sentinel always goes out, or the loop below waits forever
+			try:
+				send_files()
+			finally:
+				put(None, None)
+
+		def send_files():
+			while True:
+				try:
+					index, entry = tasks.get_nowait()
+				except queue.Empty:
+					return
+				if index is None:
+					if not put(frame_solid, solid_block(entry, codec, profile)):
+						return
+					continue
+				path, arcname, size = entry
+				h = new_hash()
+				if not put(frame_file, struct.pack('<I', index)):
+					return
+				try:
+					# reads a sample, the file may be gone since the walk
+					compress_type, level = compression_policy(path, size, profile)
+					deflate = compress_type == zipfile.ZIP_DEFLATED and level
+					with open(path, 'rb') as f:
+						while True:
+							data = f.read(native_block_size)
+							if not data:
+								break
+							h.update(data)
+							flag = 0
+							if deflate:
+								compressed = zlib.compress(data, level)
+								if len(compressed) < len(data):
+									data, flag = compressed, 1
+							if not put(frame_data, struct.pack('<IB', index, flag) + data):
+								return
+					digest = h.hexdigest().encode('ascii')
+				except EnvironmentError as e:
+					print('Error {}'.format(path))
+					print(e)
+					digest = b''  # the receiver drops the file
+				if not put(frame_end, struct.pack('<I', index) + digest):
+					return
+
+		threads = []
+		for _ in range(min(cpu_count(), len(files))):
+			t = threading.Thread(target=worker, name='Frame_Worker')
+			t.daemon = True
+			t.start()
+			threads.append(t)
+		try:
+			running = len(threads)
+			while running:
+				kind, payload = frames.get()
+				if kind is None:
+					running -= 1
+				else:
+					write_frame(writer, kind, payload)
+			write_frame(writer, frame_close, b'')
+			writer.flush()
+		finally:
+			stopped.set()
+
+	def selection(self, manifest=None, cache=None, only=None, skip=None):
+		'''(comment, select) for write_archive() and write_frames()'''
+		comment_str = self.stream_args[1]
+		select = None
+		if manifest is not None:
+			comment_str, select = self.sync_plan(manifest, cache)
+		if only is not None:
+			only = set(only)
+			select = lambda path, st, arcname: normalize_arcname(arcname) in only
+		if skip:
+			skip = set(skip)
+			chosen = select
+			select = lambda path, st, arcname: normalize_arcname(arcname) not in skip \
+				and (chosen is None or chosen(path, st, arcname))
+		return comment_str, select
+
+	def archive_names(self, manifest=None):
+		'''Names of the files write_archive() sends for manifest'''
+		file_list = self.stream_args[0]
+		select = cache = None
+		if manifest is not None:
+			cache = self.load_hashes()
+			select = self.sync_plan(manifest, cache)[1]
+		names = [normalize_arcname(arcname) for path, st, arcname
+					in walk_files(file_list, **self.walk_options)
+					if stat.S_ISREG(st.st_mode) and
+					(select is None or select(path, st, arcname))]
+		if cache is not None:
+			self.save_hashes(cache)
+		return names
+
+	def sync_plan(self, manifest, cache):
+		'''Returns (comment, select) for the diff against a receiver manifest'''
+		file_list, comment_str, profile = self.stream_args
+		comment_dict = json.loads(comment_str)
+
+		def select(path, st, arcname):
+			theirs = manifest.get(normalize_arcname(arcname))
+			if theirs is None:
+				return True
+			if stat.S_ISDIR(st.st_mode):
+				return False
+			return theirs[0] != st.st_size or \
+				cached_hash(path, st, cache) != theirs[2]
+
+		if self.sync_options['delete']:
+			names = set(normalize_arcname(arcname) for path, st, arcname
+						in walk_files(file_list, **self.walk_options))
+			# children before their directories
+			comment_dict['deleted'] = sorted(set(manifest) - names, reverse=True)
+		return json.dumps(comment_dict), select
+
+	def manifest(self, roots, walk_options):
+		'''{arcname: [size, mtime, hash]} of the local copies of roots'''
+		cache = self.load_hashes()
+		manifest = {}
+		for root in roots:
+			root_path = to_abs_path(root)
+			if not os.path.exists(root_path):
+				continue
+			for path, st, arcname in walk_files([root_path], **walk_options):
+				arcname = normalize_arcname(os.path.relpath(path, to_abs_path()))
+				if stat.S_ISDIR(st.st_mode):
+					manifest[arcname] = [None, None, None]
+				else:
+					manifest[arcname] = [st.st_size, st.st_mtime,
+											cached_hash(path, st, cache)]
+		self.save_hashes(cache)
+		return manifest
+
+	def chunk_index(self, path, st):
+		'''cached_chunks() of path from the chunk_indexes_path cache, which
+		save_chunk_indexes() writes back'''
+		return cached_chunks(path, st, self.loaded_chunk_indexes())
+
+	def loaded_chunk_indexes(self):
+		with self.chunk_lock:
+			if self.chunk_indexes is None:
+				self.chunk_indexes = self.load_hashes(self.chunk_indexes_path)
+			return self.chunk_indexes
+
+	def save_chunk_indexes(self):
+		with self.chunk_lock:
+			if self.chunk_indexes is not None:
+				self.save_hashes(dict(self.chunk_indexes), self.chunk_indexes_path)
+
+	def chunk_digests(self):
+		'''Digests of the chunks of the large files that will be sent, as far
+		as chunk indexes of them exist. A receiver only stores chunks sent
+		before, which were indexed then, so nothing is chunked here: the
+		others are indexed while they are archived. Renamed files are found
+		by their size and mtime, a wrong match only lists digests the
+		receiver does not hold.'''
+		file_list = self.stream_args[0]
+		cache = dict(self.loaded_chunk_indexes())
+		moved = dict(((entry[0], entry[1]), entry[3]) for entry in cache.values())
+		digests = set()
+		for path, st, arcname in walk_files(file_list, **self.walk_options):
+			if stat.S_ISREG(st.st_mode) and st.st_size >= dedup_min_size:
+				entry = cache.get(path)
+				if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+					index = entry[3]
+				else:
+					index = moved.get((st.st_size, st.st_mtime), [])
+				digests.update(digest for digest, length in index)
+		return sorted(digests)
+
+	def delta_candidates(self, manifest):
+		'''Large files the receiver has a different copy of, and those of
+		them that have no chunk index here yet'''
+		file_list = self.stream_args[0]
+		cache = self.load_hashes()
+		indexes = self.load_hashes(self.chunk_indexes_path)
+		changed = []
+		unindexed = []
+		for path, st, arcname in walk_files(file_list, **self.walk_options):
+			arcname = normalize_arcname(arcname)
+			theirs = manifest.get(arcname)
+			if not theirs or theirs[0] is None or st.st_size < dedup_min_size:
+				continue
+			if theirs[0] != st.st_size or cached_hash(path, st, cache) != theirs[2]:
+				changed.append(arcname)
+				entry = indexes.get(path)
+				if not (entry and entry[0] == st.st_size and entry[1] == st.st_mtime):
+					unindexed.append(arcname)
+		self.save_hashes(cache)
+		return changed, unindexed
+
+	def delta_bases(self, changed, unindexed, stats):
+		'''{arcname: (path, chunk_signature())} of the changed files worth
+		a delta. Chunking is slow, see chunk_rate, so a file without a chunk
+		index on either end is sent whole when chunking it would take longer
+		than sending it at the last measured download speed.'''
+		cache = self.load_hashes(self.chunk_indexes_path)
+		chunking, download = self.measured_rates()
+		bases = {}
+		signed = 0
+		stats.start('sign')
+		for arcname in changed:
+			path = to_abs_path(arcname)
+			st = os.stat(path)
+			entry = cache.get(path)
+			indexed = entry and entry[0] == st.st_size and entry[1] == st.st_mtime
+			chunk_bytes = (0 if indexed else st.st_size) + \
+				(st.st_size if arcname in unindexed else 0)
+			if download and chunk_bytes / chunking > st.st_size / download:
+				continue
+			index, file_digest = cached_chunks(path, st, cache)
+			bases[arcname] = (path, chunk_signature(index))
+			if not indexed:
+				signed += st.st_size
+		self.save_hashes(cache, self.chunk_indexes_path)
+		stats.stop('sign', bytes=signed, files=len(bases),
+					skipped=len(changed) - len(bases))
+		return bases
+
+	def measured_rates(self):
+		'''(chunking, download) bytes per second, the latest of the recent
+		receives that chunked and the best of those that got whole files,
+		chunk_rate and None when nothing was measured yet'''
+		chunking = download = None
+		for record in reversed(self.recent_stats()):
+			phases = record.get('phases', {})
+			if chunking is None:
+				chunking = phases.get('sign', {}).get('throughput')
+			# deltas and dedup make few bytes take as long as many
+			phase = phases.get('download_extract') or phases.get('download') or {}
+			if phase.get('throughput') and not phase.get('deltas') and \
+					not phase.get('dedup'):
+				download = max(download or 0, phase['throughput'])
+		return chunking or chunk_rate, download
+
+	def load_hashes(self, path=None):
+		'''The cache of cached_hash() or, with path, of cached_chunks()'''
+		try:
+			with open(path or self.hashes_path) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+
+	def save_hashes(self, cache, path=None):
+		with open(path or self.hashes_path, 'w') as f:
+			json.dump(cache, f)
+
+	def sync(self, file_list, delete=False, deadline=None, profile='fast'):
+		'''Send only the files that differ from the receiver's copy.
+
+		The receiver posts a manifest of its copy of file_list, see manifest(),
+		and files missing here are deleted there when delete is True.
+		'''
+		self.sync_options = {'delete': delete}
+		try:
+			self.send(file_list, stream=True, deadline=deadline, profile=profile)
+		finally:
+			self.sync_options = None
 
 	def send_text(self, share_text):
 		print('Sending the text\n"{}"'.format(share_text))
@@ -599,29 +1235,684 @@ class Transfer(object):
 		self.send([])
 
 
-def search_all_file(file_dir_list):
-	file_list = []
-	for _ in file_dir_list:
-		if os.path.isdir(_):
-			file_list.extend(return_all_file(_))
+class Transfer_Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''Serves the archive of a Transfer to several receivers at once.
+
+	It shuts itself down when `receivers` clients have received the whole
+	archive or when `deadline` seconds have passed.
+	'''
+	daemon_threads = True
+	ack_timeout = 60  # seconds a verifying receiver has to acknowledge
+
+	def __init__(self, server_address, transfer, receivers=1, deadline=None):
+		BaseHTTPServer.HTTPServer.__init__(self, server_address, Transfer_Handler)
+		self.transfer = transfer
+		self.receivers = receivers
+		self.deadline = time.time() + deadline if deadline else None
+		self.completed = 0
+		self.clients = {}
+		self.deliveries = {}  # ip -> delivered byte ranges of the archive
+		self.lock = threading.Lock()
+		self.stopping = False
+		self.verifying = set()  # IPs that acknowledge after checking hashes
+		self.unacked = {}  # ip -> (client, time) received but not acknowledged
+		self.bucket = Token_Bucket()  # all receivers
+		self.buckets = {}  # ip -> Token_Bucket of one receiver
+
+	def add_client(self, client_address, total=None):
+		client = {'ip': client_address[0], 'sent': 0, 'total': total,
+					'start': time.time(), 'done': False}
+		with self.lock:
+			self.clients[client_address] = client
+			if client['ip'] not in self.buckets:
+				self.buckets[client['ip']] = Token_Bucket()
+		self.update_rates()
+		return client
+
+	def update_rates(self):
+		'''Apply the rate limits of the transfer. The receivers that are
+		being served share the total limit equally.'''
+		total = self.transfer.rate_limit
+		with self.lock:
+			ips = set(x['ip'] for x in self.clients.values() if not x['done'])
+			self.bucket.rate = total
+			for ip, bucket in self.buckets.items():
+				rates = [x for x in (self.transfer.client_rate_limit,
+										total and total / max(len(ips), 1)) if x]
+				bucket.rate = min(rates) if rates else None
+
+	def throttle(self, client, size):
+		'''Wait until size more bytes may be sent to client'''
+		self.buckets[client['ip']].take(size)
+		self.bucket.take(size)
+
+	def piece_size(self, client, size):
+		'''The most to send to client at once, about a tenth of a second of
+		its rate'''
+		rates = [x for x in (self.bucket.rate, self.buckets[client['ip']].rate) if x]
+		if not rates:
+			return size
+		return max(min(size, int(min(rates) / 10)), 16 * 1024)
+
+	def delivered(self, client, start, end, size):
+		'''Record a served byte range; the client completes once its ranges
+		cover the whole archive'''
+		with self.lock:
+			ranges = sorted(self.deliveries.get(client['ip'], []) + [(start, end)])
+			merged = []
+			for range_start, range_end in ranges:
+				if merged and range_start <= merged[-1][1]:
+					merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+				else:
+					merged.append((range_start, range_end))
+			covered = merged[0][0] == 0 and merged[0][1] >= size
+			self.deliveries[client['ip']] = [] if covered else merged
+		if covered:
+			self.complete(client)
+
+	def complete(self, client):
+		with self.lock:
+			client['done'] = True
+			if client['ip'] in self.verifying:
+				# counted once the receiver acknowledges, it may fetch files again
+				self.unacked[client['ip']] = (client, time.time())
+				return
+			self.completed += 1
+			finished = self.completed >= self.receivers
+		# a standing receiver there is told about the next send directly
+		self.transfer.add_peer(client['ip'], self.transfer.receivers_path)
+		if self.receivers > 1:
+			print('\n{} received the file ({}/{})'.format(client['ip'], self.completed,
+															self.receivers))
+		if finished:
+			self.stop()
+
+	def ack(self, ip):
+		with self.lock:
+			self.verifying.discard(ip)
+			entry = self.unacked.pop(ip, None)
+		if entry:
+			self.complete(entry[0])
+
+	def stop(self):
+		if self.stopping:
+			return
+		self.stopping = True
+		t = threading.Thread(target=self.shutdown)
+		t.daemon = True
+		t.start()
+		print('File transfer was completed.Server is shutdowning.....')
+
+	def monitor(self):
+		'''Print per-client progress and enforce the deadline'''
+		while not self.stopping:
+			time.sleep(0.5)
+			with self.lock:
+				clients = [x for x in self.clients.values() if not x['done']]
+			if clients:
+				status = []
+				ips = []
+				for client in clients:
+					if client['ip'] not in ips:
+						ips.append(client['ip'])
+				self.update_rates()
+				for ip in ips:
+					# segmented downloads use several connections per receiver
+					connections = [x for x in clients if x['ip'] == ip]
+					sent = sum(x['sent'] for x in connections)
+					start = min(x['start'] for x in connections)
+					speed = human_size(sent / max(time.time() - start, 0.001))
+					total = connections[0]['total']
+					if len(connections) == 1 and total:
+						percent = int(100 * sent / total)
+						line = '{} {}% {}/s'.format(ip, percent, speed)
+					else:
+						line = '{} {} {}/s'.format(ip, human_size(sent), speed)
+					rate = self.buckets[ip].rate
+					if rate:
+						line += ' (max {}/s)'.format(human_size(rate))
+					status.append(line)
+				sys.stdout.write('\r' + ' | '.join(status) + ' ')
+				sys.stdout.flush()
+			with self.lock:
+				late = [ip for ip, (client, since) in self.unacked.items()
+						if time.time() - since > self.ack_timeout]
+			for ip in late:
+				self.ack(ip)
+			if self.deadline and time.time() > self.deadline:
+				print('\nDeadline passed, {}/{} receivers completed'.format(
+					self.completed, self.receivers))
+				self.stop()
+
+
+class Transfer_Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+	'''Serves the archive of server.transfer'''
+
+	def is_send_path(self):
+		transfer = self.server.transfer
+		return os.path.normpath(self.translate_path(self.path)) == \
+			os.path.normpath(transfer.send_path)
+
+	def query(self):
+		return self.path.split('?', 1)[1] if '?' in self.path else ''
+
+	def send_json(self, value):
+		body = json.dumps(value).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_info(self):
+		'''What a receiver needs to build its manifest for sync()'''
+		transfer = self.server.transfer
+		info = dict(transfer.beacon_info)
+		file_list = transfer.stream_args[0] if transfer.stream_args else []
+		info['roots'] = [normalize_arcname(re.sub('.+?Documents', '', x))
+							for x in file_list]
+		info['walk_options'] = transfer.walk_options
+		info['sync'] = transfer.sync_options
+		self.send_json(info)
+
+	def send_head(self):
+		transfer = self.server.transfer
+		if not self.is_send_path():
+			return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+		if transfer.stream:
+			# no Content-Length, the body ends when the connection is closed
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/zip')
+			self.send_header('X-Transfer-Mode', 'stream')
+			self.send_header('X-Transfer-Sender', transfer.system)
+			if transfer.sync_options:
+				self.send_header('X-Transfer-Sync', '1')
+			if transfer.dedup:
+				self.send_header('X-Transfer-Dedup', '1')
+			if transfer.native:
+				self.send_header('X-Transfer-Native', str(native_version))
+			self.send_header('X-Transfer-Verify', '1')
+			self.end_headers()
+			return None
+		try:
+			f = open(transfer.send_path, 'rb')
+		except IOError:
+			self.send_error(404, "File not found")
+			return None
+		fs = os.fstat(f.fileno())
+		size = fs.st_size
+		etag = '"{:x}-{:x}"'.format(size, int(fs.st_mtime * 1000))
+		byte_range = parse_range(self.headers.get('Range'), size)
+		if_range = self.headers.get('If-Range')
+		if byte_range and (not if_range or if_range == etag):
+			start, end = byte_range
+			if start >= size:
+				f.close()
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */{}'.format(size))
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return None
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+		else:
+			start, end = 0, size - 1
+			self.send_response(200)
+		self.send_header('Content-Type', 'application/zip')
+		self.send_header('Content-Length', str(end - start + 1))
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('ETag', etag)
+		self.send_header('X-Transfer-Mode', 'file')
+		self.send_header('X-Transfer-Sender', transfer.system)
+		self.send_header('X-Transfer-Verify', '1')
+		self.end_headers()
+		f.seek(start)
+		self.range = (start, end + 1, size)
+		return f
+
+	def do_GET(self):
+		"""Serve a GET request."""
+		transfer = self.server.transfer
+		if self.path == '/stats':
+			current = transfer.stats.record if transfer.stats else None
+			self.send_json({'current': current, 'recent': transfer.recent_stats()})
+			return
+		if self.path.split('?', 1)[0] == '/rate':
+			self.send_rate()
+			return
+		if self.is_send_path() and self.query() == 'info':
+			self.send_info()
+			return
+		if self.is_send_path() and self.query() in ('verify', 'ack'):
+			# a receiver that checks the hashes acknowledges when it is done
+			if self.query() == 'verify':
+				with self.server.lock:
+					self.server.verifying.add(self.client_address[0])
+			else:
+				self.server.ack(self.client_address[0])
+			self.send_json({'hash': new_hash().name})
+			return
+		if transfer.dedup and self.is_send_path() and self.query() == 'chunks':
+			self.send_json({'hash': new_hash().name,
+							'digests': transfer.chunk_digests()})
+			return
+		if transfer.stream and self.is_send_path():
+			self.send_head()
+			self.stream_archive()
+			return
+		f = self.send_head()
+		if f:
+			try:
+				if self.is_send_path():
+					start, end, size = self.range
+					client = self.server.add_client(self.client_address, end - start)
+					try:
+						self.copy_range(f, client, end - start)
+					except socket.error as e:
+						print('\n{} disconnected: {}'.format(client['ip'], e))
+					client['done'] = True
+					# a dropped client resumes from at most what was written
+					self.server.delivered(client, start, start + client['sent'], size)
+				else:
+					self.copyfile(f, self.wfile)
+			finally:
+				f.close()
+
+	def send_rate(self):
+		'''"/rate?total=10M&client=2M" changes the rate limits while serving,
+		"none" removes one. Only this machine may change them.'''
+		transfer = self.server.transfer
+		from six.moves.urllib_parse import parse_qs
+		values = parse_qs(self.query())
+		if values and self.client_address[0] not in ('127.0.0.1', '::1'):
+			self.send_error(403, "Rate limits can only be changed locally")
+			return
+		# both are checked before either changes
+		limits = {}
+		try:
+			for name, attr in (('total', 'rate_limit'), ('client', 'client_rate_limit')):
+				if name in values:
+					value = values[name][0]
+					limits[attr] = None if value == 'none' else parse_size(value)
+		except ValueError:
+			self.send_error(400, "Bad rate")
+			return
+		for attr, limit in limits.items():
+			setattr(transfer, attr, limit)
+		self.server.update_rates()
+		self.send_json({'total': transfer.rate_limit,
+						'client': transfer.client_rate_limit})
+
+	def do_POST(self):
+		'''A receiver posts what it already has to "?archive": the manifest
+		of its copy for sync(), the chunks it holds for dedup and the chunk
+		signatures of the old copies of the files "?plan" listed, or the
+		files that failed verification as "only", and a resumed receiver
+		the files it already has as "skip". "?files" lists the files the
+		same options would send and "?native" sends them as frames.'''
+		transfer = self.server.transfer
+		queries = ('archive', 'plan', 'files', 'native') if transfer.native else \
+			('archive', 'plan', 'files')
+		if not (transfer.stream and self.is_send_path() and self.query() in queries):
+			self.send_error(404, "File not found")
+			return
+		length = int(self.headers.get('Content-Length') or 0)
+		try:
+			options = json.loads(self.rfile.read(length).decode('utf-8'))
+		except ValueError:
+			self.send_error(400, "Bad options")
+			return
+		if self.query() == 'plan':
+			changed = unindexed = []
+			if transfer.sync_options and dedup_supported:
+				changed, unindexed = transfer.delta_candidates(options['manifest'])
+			self.send_json({'hash': new_hash().name, 'changed': changed,
+							'unindexed': unindexed})
+			return
+		manifest = options.get('manifest') if transfer.sync_options else None
+		if self.query() == 'files':
+			self.send_json({'files': transfer.archive_names(manifest)})
+			return
+		if self.query() == 'native':
+			self.send_native(manifest, options.get('only'), options.get('solid'),
+								options.get('skip'))
+			return
+		self.send_head()
+		self.stream_archive(manifest, options.get('have'), options.get('signatures'),
+							options.get('only'), options.get('skip'))
+
+	def stream_archive(self, manifest=None, have=None, signatures=None, only=None,
+						skip=None):
+		transfer = self.server.transfer
+		client = self.server.add_client(self.client_address)
+		# the hashes_member only goes to receivers that check it, see "?verify",
+		# others and unzip tools would extract it as a file
+		verify = client['ip'] in self.server.verifying
+		try:
+			transfer.write_archive(Client_Writer(self.wfile, client, self.server),
+									manifest, have, signatures, only, skip, verify)
+		except socket.error as e:
+			print('\n{} disconnected: {}'.format(client['ip'], e))
+			client['done'] = True
+		else:
+			self.server.complete(client)
+
+	def send_native(self, manifest=None, only=None, solid=None, skip=None):
+		transfer = self.server.transfer
+		# no Content-Length, the close frame ends the body
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/x-transfer-frames')
+		self.send_header('X-Transfer-Sender', transfer.system)
+		self.end_headers()
+		client = self.server.add_client(self.client_address)
+		try:
+			transfer.write_frames(Client_Writer(self.wfile, client, self.server),
+									manifest, only, solid, skip)
+		except socket.error as e:
+			print('\n{} disconnected: {}'.format(client['ip'], e))
+			client['done'] = True
+		else:
+			self.server.complete(client)
+
+	def copyfile(self, source, outputfile):
+		shutil.copyfileobj(source, outputfile, 256 * 1024)
+
+	def copy_range(self, source, client, length):
+		'''Send length bytes of source from its position to the client.
+
+		os.sendfile() moves them inside the kernel, without it the file is
+		mapped and written in large slices.
+		'''
+		offset = source.tell()
+		self.wfile.flush()  # the headers go first
+		if hasattr(os, 'sendfile'):
+			try:
+				while length > 0:
+					size = self.server.piece_size(client, min(length, 8 * 1024 * 1024))
+					sent = os.sendfile(self.connection.fileno(), source.fileno(), offset,
+										size)
+					if not sent:
+						return
+					offset += sent
+					length -= sent
+					client['sent'] += sent
+					self.server.throttle(client, sent)
+				return
+			except OSError as e:
+				# not supported for this file or socket, nothing was sent yet
+				if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+									getattr(errno, 'EOPNOTSUPP', errno.EINVAL)):
+					raise
+		try:
+			mm = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+		except (ValueError, EnvironmentError):  # empty file or no mmap here
+			mm = None
+		if mm is None:
+			outputfile = Client_Writer(self.wfile, client, self.server)
+			while length > 0:
+				data = source.read(min(length, 1024 * 1024))
+				if not data:
+					break
+				outputfile.write(data)
+				length -= len(data)
+			return
+		# a memoryview slice is written without a copy, Python 2 slices mmap
+		view = memoryview(mm) if sys.version_info[0] >= 3 else mm
+		try:
+			end = min(offset + length, len(mm))
+			while offset < end:
+				size = self.server.piece_size(client, min(end - offset, 4 * 1024 * 1024))
+				data = view[offset:offset + size]
+				try:
+					self.wfile.write(data)
+				finally:
+					if view is not mm:  # mm cannot close while slices are exported
+						data.release()
+				offset += size
+				client['sent'] += size
+				self.server.throttle(client, size)
+		finally:
+			if view is not mm:
+				view.release()
+			mm.close()
+
+	def translate_path(self, path):
+		"""Translate a /-separated PATH to the local filename syntax.
+
+		Components that mean special things to the local file system
+		(e.g. drive or directory names) are ignored.  (XXX They should
+		probably be diagnosed.)
+		"""
+		import posixpath
+		from six.moves.urllib_parse import unquote
+		# abandon query parameters
+		path = path.split('?', 1)[0]
+		path = path.split('#', 1)[0]
+		# Don't forget explicit trailing slash when normalizing. Issue17324
+		trailing_slash = path.rstrip().endswith('/')
+		path = posixpath.normpath(unquote(path))
+		words = filter(None, path.split('/'))
+		path = to_abs_path()
+		for word in words:
+			if os.path.dirname(word) or word in (os.curdir, os.pardir):
+				# Ignore components that are not a simple file/directory name
+				continue
+			path = os.path.join(path, word)
+		if trailing_slash:
+			path += '/'
+		return path
+
+
+def parse_range(value, size):
+	'''Return the inclusive (start, end) of a single "bytes=" Range header'''
+	match = re.match(r'bytes=(\d*)-(\d*)$', (value or '').strip())
+	if not match or match.groups() == ('', ''):
+		return None
+	start, end = match.groups()
+	if start == '':
+		start, end = max(size - int(end), 0), size - 1
+	else:
+		start = int(start)
+		end = min(int(end), size - 1) if end else size - 1
+	if end < start and start < size:
+		return None
+	return start, end
+
+
+class Client_Writer(object):
+	'''Counts the bytes written to one client for the progress line and
+	keeps to the rate limits of server'''
+	def __init__(self, fp, client, server=None):
+		self.fp = fp
+		self.client = client
+		self.server = server
+
+	def write(self, data):
+		step = self.server.piece_size(self.client, len(data)) if self.server else 0
+		if step >= len(data) or not step:
+			pieces = [data]
 		else:
-			file_list.append(_)
-	return file_list
+			pieces = (data[x:x + step] for x in range(0, len(data), step))
+		for piece in pieces:
+			self.fp.write(piece)
+			self.client['sent'] += len(piece)
+			if self.server:
+				self.server.throttle(self.client, len(piece))
+
+
+class Token_Bucket(object):
+	'''Rate limit shared by threads. rate is in bytes per second, None is
+	unlimited, and may change at any time.
+
+	take() lets a sender run up to `burst` seconds ahead and then sleeps
+	once for what it took beyond that, so the cost is one lock per piece
+	rather than per byte.
+	'''
+	burst = 0.25
+
+	def __init__(self, rate=None):
+		self.rate = rate
+		self.tokens = 0.0
+		self.time = time.time()
+		self.lock = threading.Lock()
+
+	def take(self, size):
+		with self.lock:
+			rate = self.rate
+			now = time.time()
+			if not rate:
+				self.tokens = 0.0
+				self.time = now
+				return
+			self.tokens = min(self.tokens + (now - self.time) * rate, rate * self.burst)
+			self.time = now
+			self.tokens -= size
+			wait = -self.tokens / rate
+		if wait > 0:
+			time.sleep(wait)
+
+
+class Stream_Writer(object):
+	'''Collects the small writes of zipfile into large socket sends.
+
+	It has tell() but no seek(), so zipfile writes data descriptors instead of
+	seeking back to patch the local headers.
+	'''
+	def __init__(self, fp, buffer_size=256 * 1024):
+		self.fp = fp
+		self.buffer_size = buffer_size
+		self.buffer = bytearray()
+		self.offset = 0
+
+	def write(self, data):
+		self.buffer += data
+		self.offset += len(data)
+		if len(self.buffer) >= self.buffer_size:
+			self.flush()
+		return len(data)
+
+	def tell(self):
+		return self.offset
+
+	def flush(self):
+		if self.buffer:
+			self.fp.write(bytes(self.buffer))
+			self.buffer = bytearray()
+
+
+class Stats(object):
+	'''Timings, sizes and counts per phase of one send() or receive(),
+	appended to the stats file as a JSON line'''
+	def __init__(self, action, system):
+		self.started = time.time()
+		self.record = {'action': action, 'system': system,
+						'python': platform.python_version(), 'started': self.started,
+						'phases': collections.OrderedDict()}
+		self.timers = {}
+
+	def start(self, name):
+		self.timers[name] = time.time()
+
+	def stop(self, name, **values):
+		seconds = time.time() - self.timers.pop(name)
+		phase = {'seconds': round(seconds, 3)}
+		phase.update(values)
+		if values.get('bytes') and seconds > 0:
+			phase['throughput'] = int(values['bytes'] / seconds)
+		self.record['phases'][name] = phase
+
+	def save(self, path):
+		self.record['seconds'] = round(time.time() - self.started, 3)
+		with open(path, 'a') as f:
+			f.write(json.dumps(self.record) + '\n')
+
+
+def tree_size(dir_path):
+	'''(file count, total size) below dir_path'''
+	files = size = 0
+	for path, st, arcname in walk_files([dir_path], hidden=True):
+		if stat.S_ISREG(st.st_mode):
+			files += 1
+			size += st.st_size
+	return files, size
+
+
+def search_all_file(file_dir_list, hidden=False):
+	return [path for path, st, arcname in walk_files(file_dir_list, hidden=hidden)]
+
+
+def return_all_file(dir_path, hidden=False):
+	if not os.path.isdir(dir_path):
+		return []
+	return search_all_file([dir_path], hidden)
+
+
+def scan_dir(dir_path):
+	'''(name, path, stat) of the directory entries, following symlinks'''
+	if hasattr(os, 'scandir'):
+		for entry in os.scandir(dir_path):
+			try:
+				yield entry.name, entry.path, entry.stat()
+			except OSError:  # broken symlink
+				pass
+	else:
+		for name in os.listdir(dir_path):
+			path = os.path.join(dir_path, name)
+			try:
+				yield name, path, os.stat(path)
+			except OSError:
+				pass
 
 
-def return_all_file(dir_path):
-	file_list = []
-	if os.path.isdir(dir_path):
-		while True:
-			dir_path += "/*"
-			_list = glob.glob(dir_path)
-			# print(len(_list))
-			if len(_list) == 0:
-				break
-			else:
-				file_list.extend(_list)
+def match_patterns(name, rel_path, patterns):
+	return any(fnmatch.fnmatch(name, x) or fnmatch.fnmatch(rel_path, x)
+				for x in patterns)
 
-	return file_list
+
+def walk_files(file_dir_list, include=None, exclude=None, hidden=False):
+	'''Yield (path, stat, arcname) for the given files and everything below
+	the given directories, in one pass and in name order.
+
+	include and exclude are glob patterns matched against the name and the
+	path relative to the given directory; excluded directories are not
+	entered, and with include only matching files are yielded. Dotfiles are
+	skipped unless hidden is True.
+	'''
+	path_pat = re.compile('.+?Documents')
+	for root in file_dir_list:
+		root_st = os.stat(root)
+		root_arcname = path_pat.sub("", root)
+		if not stat.S_ISDIR(root_st.st_mode):
+			yield root, root_st, root_arcname
+			continue
+		visited = set([(root_st.st_dev, root_st.st_ino)])
+		stack = [(root, '')]
+		while stack:
+			dir_path, rel_dir = stack.pop()
+			try:
+				entries = sorted(scan_dir(dir_path))
+			except OSError as e:
+				print('Error {}'.format(dir_path))
+				print(e)
+				continue
+			sub_dirs = []
+			for name, path, st in entries:
+				rel_path = rel_dir + name
+				if not hidden and name.startswith('.'):
+					continue
+				if exclude and match_patterns(name, rel_path, exclude):
+					continue
+				arcname = root_arcname + path[len(root):]
+				if stat.S_ISDIR(st.st_mode):
+					if (st.st_dev, st.st_ino) in visited:  # symlink loop
+						continue
+					visited.add((st.st_dev, st.st_ino))
+					if not include:
+						yield path, st, arcname
+					sub_dirs.append((path, rel_path + '/'))
+				elif not include or match_patterns(name, rel_path, include):
+					yield path, st, arcname
+			stack.extend(reversed(sub_dirs))
 
 
 def removeEmptyFolders(path, removeRoot=True):
@@ -643,6 +1934,80 @@ def removeEmptyFolders(path, removeRoot=True):
 			os.rmdir(path)
 
 
+class Beacon(object):
+	'''Announces a running server to receivers with UDP broadcasts on the
+	server port'''
+	interval = 0.5
+
+	def __init__(self, port, info, peers=()):
+		self.port = port
+		self.info = info
+		self.peers = list(peers)  # also told directly, broadcasts may be filtered
+		self.stopped = threading.Event()
+
+	def start(self):
+		t = threading.Thread(target=self.run, name='Beacon')
+		t.daemon = True
+		t.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def run(self):
+		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		data = json.dumps(self.info).encode('utf-8')
+		# some systems only deliver the directed broadcast of the subnet
+		subnet = '.'.join(port_scan.current_ip.split('.')[:3]) + '.255'
+		while True:
+			for target in ['255.255.255.255', subnet] + self.peers:
+				try:
+					s.sendto(data, (target, self.port))
+				except socket.error:
+					pass
+			if self.stopped.wait(self.interval):
+				break
+		s.close()
+
+
+def listen_beacon(port, timeout):
+	'''Wait up to timeout seconds for a Beacon. Returns its info with "ip"
+	set to the sender address, or None.'''
+	s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if hasattr(socket, 'SO_REUSEPORT'):
+		try:
+			s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		except socket.error:
+			pass
+	deadline = time.time() + timeout
+	try:
+		s.bind(('', port))
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return None
+			s.settimeout(remaining)
+			try:
+				data, address = s.recvfrom(65536)
+			except socket.timeout:
+				return None
+			try:
+				info = json.loads(data.decode('utf-8'))
+			except ValueError:
+				continue
+			if isinstance(info, dict) and info.get('service') == 'Transfer' and \
+					address[0] != port_scan.current_ip:
+				info['ip'] = address[0]
+				return info
+	except socket.error:
+		# the port is taken, wait like the old polling loop did
+		time.sleep(max(deadline - time.time(), 0))
+		return None
+	finally:
+		s.close()
+
+
 class Port_Scan(object):
 	def __init__(self, port, alert=True):
 		self.port = port
@@ -650,47 +2015,87 @@ class Port_Scan(object):
 		self.current_ip = self.get_ip()
 		assert self.current_ip, 'Cannot find IP'
 		print('This device IP is {}'.format(self.current_ip))
-		self.thread_limit = threading.Semaphore(100)
-
-	def pscan(self, ip, port):
-		try:
+		self.rtts = collections.deque(maxlen=32)  # answer times of LAN hosts
+
+	def timeout(self):
+		'''Four times the slowest recent LAN answer, 1s until one is seen'''
+		if not self.rtts:
+			return 1.0
+		return min(1.0, max(0.3, 4 * max(self.rtts)))
+
+	def probe(self, hosts, first=False, timeout=None):
+		'''Connect to all hosts at once without blocking and return the ones
+		with the port open, in the order they answered'''
+		import select  # the module level select() is the Pythonista menu
+		sockets = {}
+		start = time.time()
+		for ip in hosts:
 			s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			s.settimeout(1)
-			s.connect((ip, port))
-			s.close()
-		except:
-			# print('Port',port,'is close')
-			return False
-		else:
-			if ip == self.current_ip:
-				return False
+			s.setblocking(False)
+			err = s.connect_ex((ip, self.port))
+			if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, 10035):
+				sockets[s] = ip
 			else:
-				self.result.append(ip)
+				s.close()
+		deadline = start + (timeout or self.timeout())
+		result = []
+		try:
+			while sockets and not (first and result):
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				# failed connects are reported as exceptions on Windows
+				_, writable, errored = select.select([], list(sockets), list(sockets),
+														remaining)
+				for s in set(writable) | set(errored):
+					ip = sockets.pop(s)
+					err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+					if err in (0, errno.ECONNREFUSED, 10061):
+						# a refused connect is a live host answering too
+						self.rtts.append(time.time() - start)
+					if err == 0 and ip != self.current_ip:
+						result.append(ip)
+					s.close()
 		finally:
-			self.thread_limit.release()
+			for s in sockets:
+				s.close()
+		return result
 
-	def scan(self):
-		self.result = []
+	def neighbours(self):
+		'''Hosts in the OS neighbour table, only read on Linux'''
+		try:
+			with open('/proc/net/arp') as f:
+				lines = f.readlines()[1:]
+		except IOError:
+			return []
+		hosts = []
+		for line in lines:
+			fields = line.split()
+			# IP address, HW type, Flags, HW address, ...
+			if len(fields) >= 4 and fields[3] != '00:00:00:00:00:00' and \
+					fields[0] != self.current_ip:
+				hosts.append(fields[0])
+		return hosts
+
+	def scan(self, first=False):
+		'''Probe the neighbour table, then the rest of the /24.
+		first=True returns at the first server.'''
 		_gate_way = '.'.join(self.current_ip.split('.')[:3])
 		# gate_way = _gate_way+'.1'  # pyflakes says this is not used
 		if self.alert:
 			console.show_activity('Scanning.....')
-		for x in range(1, 256):
-			ip = '{}.{}'.format(_gate_way, x)
-			self.thread_limit.acquire()
-			threading.Thread(target=self.pscan, args=(ip, self.port),
-								name='PortScanner').start()
-
-		thread_list = [x for x in threading.enumerate() if x.name == 'PortScanner']
-		for _ in thread_list:
-			_.join()
+		neighbours = self.neighbours()
+		result = self.probe(neighbours, first) if neighbours else []
+		if not (first and result):
+			hosts = ['{}.{}'.format(_gate_way, x) for x in range(1, 256)]
+			result += self.probe([x for x in hosts if x not in neighbours], first)
 		if self.alert:
-			if self.result:
-				console.hud_alert(' '.join(self.result), 'success', 1)
+			if result:
+				console.hud_alert(' '.join(result), 'success', 1)
 			else:
 				console.hud_alert('Not found', 'error', 1)
 			console.hide_activity()
-		return self.result
+		return result
 
 	def get_ip(self):
 		try:
@@ -725,7 +2130,7 @@ class Port_Scan(object):
 						result = subprocess.check_output('ifconfig eth0 | grep -w inet',
 															shell=True)
 					except:
-						return False
+						return '127.0.0.1'  # no network, loopback only
 				ip = ''
 				if result:
 					strs = result.split('\n')
@@ -743,82 +2148,1610 @@ class Port_Scan(object):
 					return ip
 
 
-def downloader(url, file_path, progress=True, style=1):
+def sanitize_filename(filename, sender):
+	'''Replace characters that the local file system may reject'''
+	new_filename = []
+	sep = '//' if sender == 'Windows' else '/'
+	for split in filename.split(sep):
+		_split = re.sub(r'[\\|/|:|?|"|<|>|\|]', '-', split).strip()
+		new_filename.append(_split)
+	return sep.join(new_filename)
+
+
+extract_workers = 8  # threads writing members in extract_zip()
+parallel_extract_min = 64  # fewer members are written by the calling thread
+
+
+def extract_zip(zip_path, to_extract_path, verifier=None, workers=extract_workers,
+				placement=None):
+	'''Extract a downloaded archive and return its comment dict. The
+	directories are created first, then the files are written by worker
+	threads, each reading the archive through its own handle. Files are
+	hashed for verifier while they are written, placement can take them
+	to their original paths.'''
+	zf = zipfile.ZipFile(zip_path)
+	receive_comment_dict = json.loads(zf.comment.decode('utf-8'))
+	sender = receive_comment_dict['sender']
+	decoding = 'shift-jis' if sender == 'Windows' else 'utf-8'
+	infos = zf.infolist()
+	# the span of a member ends where the next one or the central directory starts
+	offsets = sorted(x.header_offset for x in infos)
+	offsets.append(getattr(zf, 'start_dir', os.path.getsize(zip_path)))
+	span_ends = dict(zip(offsets, offsets[1:]))
+
+	members = []
+	dir_paths = set()
+	for _ in infos:
+		if _.filename == hashes_member:
+			if verifier:
+				verifier.load(zf.read(_))
+			continue
+		filename = _.filename.encode('utf-8').decode(decoding, 'replace')
+		if filename.endswith('/'):
+			create_member(to_extract_path, filename, sender, placement=placement)
+		else:
+			members.append((_, filename))
+			root = member_root(to_extract_path, filename, placement)
+			dir_paths.add(os.path.dirname(member_path(root, filename)))
+	zf.close()
+	# directory skeleton, a directory that fails here is renamed by create_member
+	dirs = set()
+	for dir_path in sorted(dir_paths):
+		try:
+			make_dirs(dir_path)
+		except EnvironmentError:
+			continue
+		dirs.add(dir_path)
+
+	local = threading.local()
+	handles = []
+
+	def extract(member):
+		_, filename = member
+		if not hasattr(local, 'zf'):
+			local.zf = zipfile.ZipFile(zip_path)
+			handles.append(local.zf)
+		f, filename = create_member(to_extract_path, filename, sender, dirs,
+									placement)
+		if f is None:
+			return _, None, None, None
+		out = Hash_Writer(f)
+		error = None
+		try:
+			source = local.zf.open(_)
+			shutil.copyfileobj(source, out, 1024 * 1024)
+			source.close()
+		except (zipfile.BadZipfile, zlib.error, EnvironmentError) as e:
+			error = e
+		finally:
+			f.close()
+		digest = None if error else out.hexdigest()
+		if isinstance(f, Staged_File):
+			# the hashes_member was read above, a mismatch is not placed
+			f.commit(digest is not None and (verifier is None or
+												verifier.matches(_.filename, digest)))
+		return _, filename, digest, error
+
+	if workers > 1 and len(members) >= parallel_extract_min:
+		results = ordered_map(extract, members, workers)
+	else:
+		results = map(extract, members)
+	try:
+		for _, filename, digest, error in results:
+			if error is not None:
+				print('Error {}'.format(filename))
+				print(error)
+			# a file that could not be created is fetched again like a bad one
+			if verifier:
+				verifier.add(_.filename, digest,
+								(_.header_offset, span_ends[_.header_offset]))
+	finally:
+		for handle in handles:
+			handle.close()
+	return receive_comment_dict
+
+
+def refetch_members(url, names, to_extract_path, sender, verifier, placement=None):
+	'''Download and extract single members of the archive at url by the
+	byte spans extract_zip() recorded in verifier. Names without a span
+	were not in the archive and stay bad.'''
+	retry = Verifier(dict((name, verifier.expected.get(name)) for name in names))
+	for name in names:
+		if name not in verifier.spans:
+			continue
+		start, end = verifier.spans[name]
+		response = requests.get(url, stream=True, timeout=(10, 60),
+								headers={'Range': 'bytes={}-{}'.format(start, end - 1)})
+		if response.status_code != 206:
+			raise ValueError('The server cannot send parts of the archive')
+		reader = Chunk_Reader(stream_chunks(response))
+		if reader.read(4) == b'PK\x03\x04':
+			stream_extract_member(reader, to_extract_path, sender, verifier=retry,
+									placement=placement)
+	return retry
+
+
+def member_path(to_extract_path, filename):
+	'''Join an archive member name to to_extract_path the way zipfile does,
+	dropping drive letters, empty, "." and ".." components'''
+	arcname = filename.replace('/', os.path.sep)
+	if os.path.altsep:
+		arcname = arcname.replace(os.path.altsep, os.path.sep)
+	arcname = os.path.splitdrive(arcname)[1]
+	invalid_path_parts = ('', os.path.curdir, os.path.pardir)
+	arcname = os.path.sep.join(x for x in arcname.split(os.path.sep)
+								if x not in invalid_path_parts)
+	return os.path.join(to_extract_path, arcname)
+
+
+def make_dirs(path):
+	'''os.makedirs() that accepts an existing directory, also one another
+	thread created first'''
+	try:
+		os.makedirs(path)
+	except OSError:
+		if not os.path.isdir(path):
+			raise
+
+
+class Placement(object):
+	'''Members written straight to their original paths under root instead
+	of the transfer folder, each through a Staged_File. Members named in
+	keep, files whose replacement was declined, still go to the folder.'''
+	def __init__(self, root, keep=()):
+		self.root = root
+		self.keep = set(keep)
+		self.placed = []  # paths renamed into place
+
+	def places(self, filename):
+		return normalize_arcname(filename) not in self.keep
+
+
+class Staged_File(object):
+	'''Written under a hidden name next to path and renamed over path by
+	commit(), so path never holds a partial file'''
+	def __init__(self, path, placement):
+		dir_path, name = os.path.split(path)
+		self.path = path
+		self.temp_path = os.path.join(dir_path, '.{}.transfer-part'.format(name))
+		self.placement = placement
+		self.f = open(self.temp_path, 'wb')
+
+	def write(self, data):
+		self.f.write(data)
+
+	def close(self):
+		self.f.close()
+
+	def commit(self, ok=True):
+		'''Rename the file into place, or drop it when ok is False'''
+		self.f.close()
+		if ok:
+			# Python 2 has no os.replace(), its rename replaces files on POSIX
+			try:
+				getattr(os, 'replace', os.rename)(self.temp_path, self.path)
+			except EnvironmentError as e:
+				print('Error {}'.format(self.path))
+				print(e)
+			else:
+				self.placement.placed.append(self.path)
+				return
+		os.remove(self.temp_path)
+
+
+def member_root(to_extract_path, filename, placement=None):
+	'''The directory a member is extracted below, see Placement'''
+	if placement is not None and placement.places(filename):
+		return placement.root
+	return to_extract_path
+
+
+def create_member(to_extract_path, filename, sender, dirs=(), placement=None):
+	'''Create the directory or open the file for a member, renaming it when
+	the original name is rejected. dirs holds directories known to exist,
+	files that placement takes are opened as a Staged_File.
+	Returns (file or None, filename)'''
+	for attempt in range(2):
+		root = member_root(to_extract_path, filename, placement)
+		path = member_path(root, filename)
+		try:
+			f = None
+			if filename.endswith('/'):
+				make_dirs(path)
+			else:
+				dir_path = os.path.dirname(path)
+				if dir_path not in dirs:
+					make_dirs(dir_path)
+				if root == to_extract_path:
+					f = open(path, 'wb')
+				else:
+					f = Staged_File(path, placement)
+		except Exception as e:
+			if attempt:
+				print('Error {}'.format(filename))
+				print(e)
+				return None, None
+			filename = sanitize_filename(filename, sender)
+		else:
+			if attempt:
+				print('Renamed {}'.format(filename))
+			return f, filename
+
+
+class Chunk_Reader(object):
+	'''Reads exact sizes from an iterator of byte chunks without copying the
+	whole buffer on every read'''
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.buffer = b''
+		self.pos = 0
+
+	def read(self, size):
+		while len(self.buffer) - self.pos < size:
+			try:
+				chunk = next(self.chunks)
+			except StopIteration:
+				break
+			self.buffer = self.buffer[self.pos:] + chunk
+			self.pos = 0
+		data = self.buffer[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def read_some(self, size):
+		'''Return up to size bytes, at most one chunk, b'' at the end'''
+		while self.pos >= len(self.buffer):
+			try:
+				self.buffer = next(self.chunks)
+			except StopIteration:
+				return b''
+			self.pos = 0
+		data = self.buffer[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def unread(self, size):
+		'''Give back the tail of the last read_some()'''
+		self.pos -= size
+
+
+# connect timeout and seconds a stream may go without data
+stream_timeout = (10, 120)
+
+
+def resume_options(url, data, done):
+	'''(url, data) that ask a stream sender for everything but the member
+	names in done, see "skip" in Transfer.write_archive()'''
+	base_url, query = (url.split('?', 1) + [''])[:2]
+	options = json.loads(data) if data else {}
+	options['skip'] = sorted(done)
+	return base_url + '?' + (query or 'archive'), json.dumps(options)
+
+
+def stream_extract(url, to_extract_path, progress=True, data=None, store=None,
+					bases=None, callback=None, verifier=None, placement=None,
+					retries=5):
+	'''Extract the archive at url while it is downloading.
+
+	Local file headers are parsed as they arrive, so each member is written
+	once, straight into to_extract_path. With data the archive is requested
+	with a POST. Recipe members are rebuilt from the chunks in store and
+	bases, {member name: (old copy, chunk_signature())}. callback is passed
+	to Progress, verifier gets the digests of the files and placement can
+	take them to their original paths. Returns the archive comment dict.
+
+	A stream has no stable offset to resume at, so after a dropped
+	connection the archive is requested again without the members that
+	were already written, up to retries times.
+	'''
+	done = set()
+	# placed files wait for the hashes_member at the end of the archive
+	pending = {} if verifier is not None and placement is not None else None
+	try:
+		return stream_attempts(url, to_extract_path, progress, data, store, bases,
+								callback, verifier, placement, retries, done, pending)
+	finally:
+		for name, staged in (pending or {}).items():
+			staged.commit(verifier.matches(name, verifier.digests.get(name)))
+
+
+def stream_attempts(url, to_extract_path, progress, data, store, bases, callback,
+					verifier, placement, retries, done, pending):
+	'''The requests of stream_extract()'''
+	for attempt in range(retries + 1):
+		if done:
+			url, data = resume_options(url, data, done)
+		try:
+			if data is None:
+				response = requests.get(url, stream=True, timeout=stream_timeout)
+			else:
+				response = requests.post(url, data=data, stream=True,
+											timeout=stream_timeout)
+			response.raise_for_status()
+			sender = response.headers.get('X-Transfer-Sender')
+			chunks = stream_chunks(response)
+			if progress or callback:
+				chunks = progress_chunks(chunks, style=1 if progress else None,
+											callback=callback)
+			reader = Chunk_Reader(chunks)
+			while True:
+				signature = reader.read(4)
+				if signature != b'PK\x03\x04':
+					break
+				name = stream_extract_member(reader, to_extract_path, sender, store, bases,
+												verifier, placement, pending)
+				if name != hashes_member:
+					done.add(name)
+			comment = read_zip_comment(reader, signature)
+		except (requests.exceptions.ConnectionError,
+				requests.exceptions.ChunkedEncodingError,
+				requests.exceptions.Timeout, EOFError) as e:
+			if attempt == retries:
+				raise
+			print('\nConnection lost ({}), resuming after {} files.....'.format(
+				e, len(done)))
+			time.sleep(min(2 ** attempt, 10))
+			continue
+		if comment:
+			return json.loads(comment.decode('utf-8'))
+		return {'sender': sender}
+
+
+def stream_extract_member(reader, to_extract_path, sender, store=None, bases=None,
+							verifier=None, placement=None, pending=None):
+	'''Extract the member whose signature was just read and return its
+	name. A placed file is renamed into place once its CRC and its digest
+	match, or added to pending while the digests are not known yet.'''
+	header = reader.read(26)
+	if len(header) < 26:
+		raise EOFError('Archive is truncated')
+	(_, flag, method, _, _, crc, compress_size, file_size, name_length,
+		extra_length) = struct.unpack('<HHHHHIIIHH', header)
+	filename = reader.read(name_length)
+	extra = reader.read(extra_length)
+	zip64 = recipe = False
+	while len(extra) >= 4:
+		extra_id, length = struct.unpack('<HH', extra[:4])
+		if extra_id == recipe_extra_id:
+			recipe = True
+		elif extra_id == 1:  # ZIP64 sizes
+			zip64 = True
+			values = extra[4:4 + length]
+			if file_size == 0xFFFFFFFF:
+				file_size = struct.unpack('<Q', values[:8])[0]
+				values = values[8:]
+			if compress_size == 0xFFFFFFFF:
+				compress_size = struct.unpack('<Q', values[:8])[0]
+		extra = extra[4 + length:]
+	decoding = 'shift-jis' if sender == 'Windows' else 'utf-8'
+	if flag & 0x800:
+		decoding = 'utf-8'
+	filename = filename.decode(decoding, 'replace')
+	name = filename
+	base = bases.get(filename) if bases else None
+	if name == hashes_member:
+		f = io.BytesIO()
+	else:
+		f, filename = create_member(to_extract_path, filename, sender,
+									placement=placement)
+	staged = f if isinstance(f, Staged_File) else None
+	out = f = Hash_Writer(f) if f else None
+	try:
+		crc_ok = read_member(reader, filename, flag, method, crc, compress_size, zip64,
+								recipe and (store, base), out)
+	except Exception:
+		# no handle or hidden part file is left behind
+		if f:
+			f.close()
+		if staged:
+			staged.commit(False)
+		raise
+	if f:
+		if name == hashes_member:
+			hashes_data = f.f.getvalue()
+		f.close()
+	if filename and not crc_ok:
+		print('Error {}'.format(filename))
+		print('Bad CRC-32')
+	if verifier and f:
+		if name == hashes_member:
+			verifier.load(hashes_data)
+		elif not name.endswith('/'):
+			verifier.add(name, f.hexdigest() if crc_ok else None)
+	if staged:
+		if pending is not None and verifier.expected is None:
+			pending[name] = staged
+		else:
+			ok = crc_ok and (verifier is None or verifier.matches(name, f.hexdigest()))
+			staged.commit(ok)
+	return name
+
+
+def read_member(reader, filename, flag, method, crc, compress_size, zip64, recipe, f):
+	'''Write the data of a member to f, or only check it when f is None.
+	recipe is (store, base) to rebuild a recipe member from. Returns whether
+	the CRC-32 matched.'''
+	out = f
+	if recipe:
+		store, base = recipe
+		if store is None and base is None:
+			raise ValueError('{} needs a chunk store'.format(filename))
+		out = Recipe_Writer(f, store, base)
+
+	data_descriptor = flag & 0x08
+	remaining = None if data_descriptor else compress_size
+	crc_value = 0
+	if method == zipfile.ZIP_DEFLATED:
+		decompressor = zlib.decompressobj(-15)
+	elif method != zipfile.ZIP_STORED or data_descriptor:
+		raise ValueError('Cannot stream {} (method {})'.format(filename, method))
+	try:
+		while remaining != 0:
+			size = 1024 * 1024 if remaining is None else min(remaining, 1024 * 1024)
+			data = reader.read_some(size)
+			if not data:
+				raise EOFError('Archive is truncated')
+			if remaining is not None:
+				remaining -= len(data)
+			if method == zipfile.ZIP_DEFLATED:
+				decompressed = decompressor.decompress(data, 1024 * 1024)
+				while True:
+					if out:
+						out.write(decompressed)
+					crc_value = zlib.crc32(decompressed, crc_value)
+					# at the end of the member the rest of the input stays in
+					# unconsumed_tail as well as in unused_data
+					if not decompressor.unconsumed_tail or \
+							getattr(decompressor, 'eof', False):
+						break
+					decompressed = decompressor.decompress(decompressor.unconsumed_tail,
+															1024 * 1024)
+				if decompressor.unused_data or getattr(decompressor, 'eof', False):
+					reader.unread(len(decompressor.unused_data))
+					break
+			else:
+				if out:
+					out.write(data)
+				crc_value = zlib.crc32(data, crc_value)
+		if recipe and not out.finished():
+			raise EOFError('Recipe of {} is truncated'.format(filename))
+	finally:
+		if recipe:
+			out.close()
+	if data_descriptor:
+		descriptor = reader.read(4)
+		if descriptor == b'PK\x07\x08':
+			descriptor = reader.read(4)
+		crc = struct.unpack('<I', descriptor)[0]
+		reader.read(16 if zip64 else 8)
+	return (crc_value & 0xFFFFFFFF) == crc
+
+
+# the native protocol, see Transfer.write_frames(): every frame is a kind
+# byte and the payload length, then the payload
+native_version = 1
+frame_header = struct.Struct('<BI')
+frame_manifest = 0  # JSON: comment, hash name, files [[name, size]], dirs
+frame_file = 1  # file index, the file starts
+frame_data = 2  # file index, 1 if the block is zlib compressed, block
+frame_end = 3  # file index, hex digest of the file or nothing after an error
+frame_close = 4
+frame_solid = 5  # index length, JSON index, small files compressed together
+native_block_size = 256 * 1024
+native_queue_frames = 16  # blocks waiting for the connection
+# trees of small files go in solid blocks, see Transfer.write_frames()
+solid_average_size = 32 * 1024
+solid_member_limit = 256 * 1024
+solid_block_size = 1024 * 1024
+solid_codecs = ['lzma', 'zlib'] if lzma else ['zlib']
+
+
+def write_frame(fp, kind, payload):
+	fp.write(frame_header.pack(kind, len(payload)))
+	fp.write(payload)
+
+
+def solid_codec(accepted, profile='fast'):
+	'''The codec for solid blocks that the receiver accepts, lzma for the
+	"small" profile, or None'''
+	accepted = accepted or []
+	if profile == 'small' and lzma and 'lzma' in accepted:
+		return 'lzma'
+	return 'zlib' if 'zlib' in accepted else None
+
+
+def solid_block(entries, codec, profile='fast'):
+	'''Payload of a solid frame for [(file index, (path, arcname, size))].
+	The index lists [file index, size, digest] in the order of the data, a
+	file that cannot be read has no data and an empty digest.'''
+	index = []
+	data = []
+	for file_index, (path, arcname, size) in entries:
+		try:
+			with open(path, 'rb') as f:
+				content = f.read()
+		except EnvironmentError as e:
+			print('Error {}'.format(path))
+			print(e)
+			index.append([file_index, 0, ''])
+			continue
+		h = new_hash()
+		h.update(content)
+		index.append([file_index, len(content), h.hexdigest()])
+		data.append(content)
+	data = b''.join(data)
+	if codec == 'lzma':
+		# a dictionary beyond the block only costs memory
+		data = lzma.compress(data, filters=[{'id': lzma.FILTER_LZMA2, 'preset': 6,
+												'dict_size': solid_block_size}])
+	else:
+		data = zlib.compress(data, compression_profiles[profile][-1][1])
+	index = json.dumps({'codec': codec, 'files': index}).encode('utf-8')
+	return struct.pack('<I', len(index)) + index + data
+
+
+def native_extract(url, to_extract_path, progress=True, data=None, callback=None,
+					verifier=None, placement=None, retries=5):
+	'''Receive the files at url sent as native frames and return the comment
+	dict. data are the options posted to "?native" like for "?archive".
+	Every file is checked against the digest of its end frame as soon as it
+	is complete, verifier and placement are used like in stream_extract().
+	Solid blocks are read with the codecs in solid_codecs if data asks for
+	them. After a dropped connection the files that are not complete yet
+	are requested again, up to retries times.
+	'''
+	done = set()
+	for attempt in range(retries + 1):
+		if done:
+			url, data = resume_options(url, data, done)
+		outs = {}  # file index -> Hash_Writer of the files in flight
+		try:
+			return read_frames(url, data, to_extract_path, progress, callback, verifier,
+								placement, outs, done)
+		except (requests.exceptions.ConnectionError,
+				requests.exceptions.ChunkedEncodingError,
+				requests.exceptions.Timeout, EOFError) as e:
+			if attempt == retries:
+				raise
+			print('\nConnection lost ({}), resuming after {} files.....'.format(
+				e, len(done)))
+			time.sleep(min(2 ** attempt, 10))
+		finally:
+			# files cut off by the error are written again by the next attempt
+			for out in outs.values():
+				if out:
+					out.close()
+					if isinstance(out.f, Staged_File):
+						out.f.commit(False)
+
+
+def read_frames(url, data, to_extract_path, progress, callback, verifier, placement,
+				outs, done):
+	'''One request of native_extract(). The names of complete files are
+	added to done.'''
+	response = requests.post(url, data=data or '{}', stream=True,
+								timeout=stream_timeout)
+	response.raise_for_status()
+	sender = response.headers.get('X-Transfer-Sender')
+	chunks = stream_chunks(response)
+	if progress or callback:
+		chunks = progress_chunks(chunks, style=1 if progress else None,
+									callback=callback)
+	reader = Chunk_Reader(chunks)
+	head = None
+
+	def finish(index, out, digest):
+		'''Check a complete file against the sender's digest'''
+		out.close()
+		name = head['files'][index][0]
+		# without a hash of the same kind only a read error on the sender is seen
+		same_hash = head['hash'] == new_hash().name
+		ok = digest is not None and (not same_hash or out.hexdigest() == digest)
+		if not ok:
+			print('Error {}'.format(name))
+			print('The file does not match the sender\'s')
+		if isinstance(out.f, Staged_File):
+			out.f.commit(ok)
+		if verifier:
+			if same_hash and digest:
+				verifier.expected[name] = digest
+			verifier.add(name, out.hexdigest() if ok else None)
+		done.add(name)
+
+	while True:
+		header = reader.read(frame_header.size)
+		if len(header) < frame_header.size:
+			raise EOFError('Transfer is truncated')
+		kind, length = frame_header.unpack(header)
+		payload = reader.read(length)
+		if len(payload) < length:
+			raise EOFError('Transfer is truncated')
+		if kind == frame_manifest:
+			head = json.loads(payload.decode('utf-8'))
+			for name in head['dirs']:
+				create_member(to_extract_path, name + '/', sender, placement=placement)
+			if verifier and head['hash'] == new_hash().name and verifier.expected is None:
+				# the digests come with the end frames
+				verifier.expected = dict((entry[0], None) for entry in head['files'])
+		elif kind == frame_file:
+			index = struct.unpack('<I', payload)[0]
+			f, filename = create_member(to_extract_path, head['files'][index][0], sender,
+										placement=placement)
+			outs[index] = Hash_Writer(f) if f else None
+		elif kind == frame_data:
+			index, compressed = struct.unpack('<IB', payload[:5])
+			out = outs[index]
+			if out:
+				out.write(zlib.decompress(payload[5:]) if compressed else payload[5:])
+		elif kind == frame_end:
+			index = struct.unpack('<I', payload[:4])[0]
+			digest = payload[4:].decode('ascii') or None
+			out = outs.pop(index)
+			if out:
+				finish(index, out, digest)
+		elif kind == frame_solid:
+			length = struct.unpack('<I', payload[:4])[0]
+			index = json.loads(payload[4:4 + length].decode('utf-8'))
+			block = payload[4 + length:]
+			block = lzma.decompress(block) if index['codec'] == 'lzma' else \
+				zlib.decompress(block)
+			offset = 0
+			for file_index, size, digest in index['files']:
+				f, filename = create_member(to_extract_path, head['files'][file_index][0],
+											sender, placement=placement)
+				if f:
+					out = Hash_Writer(f)
+					out.write(block[offset:offset + size])
+					finish(file_index, out, digest or None)
+				offset += size
+		elif kind == frame_close:
+			# read to the end of the body so the progress is finished
+			while reader.read_some(1024 * 1024):
+				pass
+			return head['comment']
+		else:
+			raise ValueError('Unknown frame {}'.format(kind))
+
+
+class Hash_Writer(object):
+	'''Hashes what is written to f'''
+	def __init__(self, f):
+		self.f = f
+		self.hash = new_hash()
+
+	def write(self, data):
+		self.hash.update(data)
+		self.f.write(data)
+
+	def hexdigest(self):
+		return self.hash.hexdigest()
+
+	def close(self):
+		self.f.close()
+
+
+class Verifier(object):
+	'''Checks extracted files against the hashes_member of their archive'''
+	def __init__(self, expected=None):
+		self.expected = expected  # member name -> digest
+		self.digests = {}  # member name -> digest, None after a CRC error
+		self.spans = {}  # member name -> (start, end) in the archive
+
+	def load(self, data):
+		hashes = json.loads(data.decode('utf-8'))
+		if hashes['hash'] != new_hash().name:
+			print('Cannot check {} hashes here'.format(hashes['hash']))
+			return
+		self.expected = hashes['files']
+
+	def add(self, name, digest, span=None):
+		self.digests[name] = digest
+		if span:
+			self.spans[name] = span
+
+	def matches(self, name, digest):
+		'''Whether digest, None after a CRC error, fits the sender's file'''
+		expected = (self.expected or {}).get(name)
+		return digest is not None and (expected is None or expected == digest)
+
+	def bad(self):
+		'''Names of the files that do not match the sender's, or that the
+		sender listed and did not arrive. An expected digest of None only
+		asks for the file.'''
+		missing = set(self.expected or {}) - set(self.digests)
+		return sorted(missing.union(name for name, digest in self.digests.items()
+									if not self.matches(name, digest)))
+
+
+class Recipe_Writer(object):
+	'''Rebuilds a file from the records of a recipe member, see
+	write_recipe(). Referenced chunks come from base, the older copy of the
+	file, or from store, where literal chunks are added.'''
+	record = struct.Struct('<B40sI')
+
+	def __init__(self, f, store=None, base=None):
+		self.f = f
+		self.store = store
+		self.base = base  # (path, {digest: (offset, length)})
+		self.base_file = None
+		self.buffer = b''
+		self.literal = None  # (digest, length) of the chunk being received
+
+	def chunk(self, digest):
+		if self.base and digest in self.base[1]:
+			offset, length = self.base[1][digest]
+			if self.base_file is None:
+				self.base_file = open(self.base[0], 'rb')
+			self.base_file.seek(offset)
+			return self.base_file.read(length)
+		if self.store:
+			return self.store.get(digest)
+
+	def write(self, data):
+		self.buffer += data
+		size = self.record.size
+		while True:
+			if self.literal is None:
+				if len(self.buffer) < size:
+					return
+				kind, digest, length = self.record.unpack(self.buffer[:size])
+				self.buffer = self.buffer[size:]
+				digest = digest.decode('ascii')
+				if kind == 0:
+					data = self.chunk(digest)
+					if data is None:
+						raise IOError('Chunk {} is missing'.format(digest))
+					if self.f:
+						self.f.write(data)
+					continue
+				self.literal = (digest, length)
+			digest, length = self.literal
+			if len(self.buffer) < length:
+				return
+			data, self.buffer = self.buffer[:length], self.buffer[length:]
+			if chunk_digest(data) != digest:
+				raise ValueError('Chunk {} is corrupted'.format(digest))
+			if self.store:
+				self.store.put(digest, data)
+			if self.f:
+				self.f.write(data)
+			self.literal = None
+
+	def finished(self):
+		return self.literal is None and not self.buffer
+
+	def close(self):
+		if self.base_file:
+			self.base_file.close()
+
+
+def read_zip_comment(reader, head):
+	'''Skip the central directory and return the end record comment'''
+	tail = head
+	while True:
+		data = reader.read_some(1024 * 1024)
+		if not data:
+			break
+		tail = (tail + data)[-(0xFFFF + 22):]
+	index = tail.rfind(b'PK\x05\x06')
+	if index < 0:
+		raise EOFError('Archive is truncated')
+	comment_length = struct.unpack('<H', tail[index + 20:index + 22])[0]
+	return tail[index + 22:index + 22 + comment_length]
+
+
+# memory the chunks of one download may hold, shared by its connections
+download_buffer_budget = 4 * 1024 * 1024
+progress_interval = 0.2  # seconds between progress updates
+
+
+def stream_chunks(response, max_size=download_buffer_budget, min_size=64 * 1024):
+	'''Yield the body of a streamed response in chunks of about a quarter
+	second of the measured throughput, between min_size and max_size'''
+	size = min_size
+	while True:
+		start = time.time()
+		try:
+			data = response.raw.read(size, decode_content=True)
+		except (ProtocolError, ReadTimeoutError, socket.error) as e:
+			raise requests.exceptions.ConnectionError(e)
+		if not data:
+			return
+		yield data
+		elapsed = time.time() - start
+		if elapsed < 0.1:
+			size = min(size * 2, max_size)
+		elif elapsed > 0.5:
+			size = max(size // 2, min_size)
+
+
+class Progress(object):
+	'''Tracks a download and renders it at most every `interval` seconds.
+
+	style 1 is a bar, 2 a counter and None prints nothing. callback, if
+	given, is called as callback(done, total_length, bytes per second) at
+	the same rate. Without total_length only the size and speed are shown.
+	'''
+	def __init__(self, total_length=None, dl=0, style=1, callback=None,
+					interval=progress_interval):
+		self.total_length = total_length
+		self.dl = dl
+		self.style = style
+		self.callback = callback
+		self.interval = interval
+		self.dl_time = self.render_time = time.time()
+		self.dl_speed = None  # bytes per second over the last full second
+		self.dl_size_per_sec = 0
+		self.eta = 0
+
+	def update(self, size):
+		self.dl += size
+		self.dl_size_per_sec += size
+		now = time.time()
+		if now - self.dl_time >= 1:
+			# to get dl speed
+			self.dl_speed = self.dl_size_per_sec / (now - self.dl_time)
+			self.dl_time = now
+			if self.total_length and self.dl_speed:
+				self.eta = (self.total_length - self.dl) / self.dl_speed
+			self.dl_size_per_sec = 0
+		if now - self.render_time >= self.interval:
+			self.render_time = now
+			self.render()
+
+	def render(self):
+		total_length = self.total_length
+		speed = self.dl_speed
+		if speed is None:
+			speed = self.dl_size_per_sec / max(time.time() - self.dl_time, 0.001)
+		if self.callback:
+			self.callback(self.dl, total_length, speed)
+		if self.style is None:
+			return
+		speed = human_size(speed)
+		if not total_length:
+			sys.stdout.write("\r{} {}/s ".format(human_size(self.dl), speed))
+			sys.stdout.flush()
+			return
+
+		done = int(50 * self.dl / total_length)
+		percent = int(100 * self.dl / total_length)
+		eta_min = int(self.eta / 60)
+		eta_sec = int(self.eta % 60)
+		if eta_min == 0 and eta_sec == 0:
+			eta_text = "∞"
+		else:
+			eta_text = "{:02}:{:02}".format(eta_min, eta_sec)
+		if percent == 100:
+			eta_text = "00:00"
+		if self.style == 1:
+			fmt = "\r[{}{}]{} {}% {}/s {} "
+			sys.stdout.write(fmt.format('=' * done, ' ' * (50 - done),
+										human_size(total_length), percent, speed,
+										eta_text))
+		if self.style == 2:
+			fmt = "\r{}/{} {}％ {}/s {} "
+			sys.stdout.write(fmt.format(human_size(self.dl, True),
+										human_size(total_length), percent, speed,
+										eta_text))
+		sys.stdout.flush()
+
+	def finish(self):
+		self.render()
+		if self.style is not None:
+			print('')
+
+
+def progress_chunks(chunks, total_length=None, dl=0, style=1, callback=None):
+	'''Report the progress while passing the chunks through'''
+	progress = Progress(total_length, dl, style, callback)
+	for data in chunks:
+		progress.update(len(data))
+		yield data
+	progress.finish()
+
+
+def downloader(url, file_path, progress=True, style=1, retries=5, segments=0,
+				callback=None):
+	'''Download url to file_path, resuming after dropped connections.
+
+	The body is streamed in chunks within download_buffer_budget. progress
+	prints the progress line, callback(done, total, speed) gets the same
+	updates, see Progress.
+
+	A partial file is kept next to a .part file holding the ETag and size
+	the server reported, so a later call continues from the last byte as long
+	as the server still serves the same archive.
+
+	Large files from servers with Range support are fetched over up to
+	`segments` connections, 0 tunes the count from the measured speed.
+	'''
 	_file_path = os.path.basename(file_path)
-	with open(file_path, "wb") as f:
-		print("Downloading %s" % _file_path)
-		response = requests.get(url, stream=True)
-		total_length = response.headers.get('content-length')
+	part_path = file_path + '.part'
+	print("Downloading %s" % _file_path)
+	if segments != 1:
+		head = requests.head(url, timeout=(10, 60))
+		size = int(head.headers.get('content-length') or 0)
+		etag = head.headers.get('ETag')
+		if head.headers.get('Accept-Ranges') == 'bytes' and etag and \
+				size >= 2 * segment_block_size:
+			segmented_downloader(url, file_path, size, etag, segments, progress,
+									style, retries, callback)
+			return
+	for attempt in range(retries + 1):
+		offset = 0
+		part = {}
+		if os.path.isfile(file_path) and os.path.isfile(part_path):
+			with open(part_path) as f:
+				part = json.load(f)
+			offset = os.path.getsize(file_path)
+			if offset >= part['size'] or 'done' in part:
+				offset = 0
+		headers = {}
+		if offset:
+			headers['Range'] = 'bytes={}-'.format(offset)
+			headers['If-Range'] = part['etag']
+		try:
+			response = requests.get(url, stream=True, headers=headers,
+									timeout=(10, 60))
+			response.raise_for_status()
+			total_length = response.headers.get('content-length')
+			etag = response.headers.get('ETag')
+			if response.status_code == 206:
+				total_length = response.headers['Content-Range'].split('/')[-1]
+				print('Resuming from {}'.format(human_size(offset)))
+			else:
+				offset = 0
+			total_length = int(total_length) if total_length else None
+			if etag and total_length:
+				with open(part_path, 'w') as f:
+					json.dump({'etag': etag, 'size': total_length}, f)
+			elif os.path.isfile(part_path):
+				os.remove(part_path)
+			with open(file_path, 'ab' if offset else 'wb') as f:
+				chunks = stream_chunks(response)
+				if progress or callback:
+					chunks = progress_chunks(chunks, total_length, offset,
+												style if progress else None, callback)
+				for data in chunks:
+					f.write(data)
+		except (requests.exceptions.ConnectionError,
+				requests.exceptions.ChunkedEncodingError,
+				requests.exceptions.Timeout) as e:
+			if attempt == retries or not os.path.isfile(part_path):
+				raise
+			print('\nConnection lost ({}), retrying.....'.format(e))
+			time.sleep(min(2 ** attempt, 10))
+		else:
+			if os.path.isfile(part_path):
+				os.remove(part_path)
+			return
+
+
+segment_block_size = 8 * 1024 * 1024
+
+
+def segmented_downloader(url, file_path, size, etag, segments=0, progress=True,
+							style=1, retries=5, callback=None):
+	'''Fetch url as byte ranges over several connections into a preallocated
+	file.
+
+	Connections pull 8 MB blocks from a shared queue and write them in place.
+	With segments=0 it starts with two connections and adds one each second
+	while the aggregate speed keeps improving by more than 10%, up to 8.
+	Finished blocks are recorded in the .part file for resuming.
+	'''
+	part_path = file_path + '.part'
+	block_size = segment_block_size
+	block_count = (size + block_size - 1) // block_size
+	part = {}
+	if os.path.isfile(file_path) and os.path.isfile(part_path):
+		with open(part_path) as f:
+			part = json.load(f)
+		if part.get('etag') != etag or part.get('size') != size:
+			part = {}
+		elif 'done' not in part:
+			# continue a sequential download from its last complete block
+			offset = os.path.getsize(file_path)
+			part['done'] = list(range(offset // block_size))
+	if part.get('block_size', block_size) != block_size or 'done' not in part:
+		part = {'etag': etag, 'size': size, 'block_size': block_size, 'done': []}
+		open(file_path, 'wb').close()
+	with open(file_path, 'r+b') as f:
+		f.truncate(size)
+	done = set(part['done'])
+	blocks = queue.Queue()
+	for index in range(block_count):
+		if index not in done:
+			blocks.put(index)
+	state = {'received': sum(min(block_size, size - x * block_size) for x in done),
+				'error': None}
+	lock = threading.Lock()
+
+	def worker():
+		session = requests.Session()
+		with open(file_path, 'r+b') as f:
+			while not state['error']:
+				try:
+					index = blocks.get_nowait()
+				except queue.Empty:
+					return
+				start = index * block_size
+				end = min(start + block_size, size) - 1
+				for attempt in range(retries + 1):
+					got = 0
+					try:
+						headers = {'Range': 'bytes={}-{}'.format(start, end), 'If-Range': etag}
+						response = session.get(url, headers=headers, stream=True,
+												timeout=(10, 60))
+						if response.status_code != 206:
+							raise ValueError('The archive changed on the server')
+						f.seek(start)
+						# the buffer budget is split between the connections
+						for data in stream_chunks(response,
+													download_buffer_budget // max_workers):
+							f.write(data)
+							got += len(data)
+							with lock:
+								state['received'] += len(data)
+						if got != end - start + 1:
+							raise EOFError('Block {} is incomplete'.format(index))
+						break
+					except (requests.exceptions.ConnectionError,
+							requests.exceptions.ChunkedEncodingError,
+							requests.exceptions.Timeout, EOFError) as e:
+						with lock:
+							state['received'] -= got
+						if attempt == retries:
+							state['error'] = e
+							return
+						time.sleep(min(2 ** attempt, 10))
+					except Exception as e:
+						state['error'] = e
+						return
+				with lock:
+					done.add(index)
+					part['done'] = sorted(done)
+					with open(part_path, 'w') as part_file:
+						json.dump(part, part_file)
+
+	max_workers = segments or 8
+	workers = []
+
+	def start_worker():
+		t = threading.Thread(target=worker, name='Segment')
+		t.daemon = True
+		t.start()
+		workers.append(t)
+
+	for _ in range(min(max_workers, 2) if not segments else max_workers):
+		start_worker()
+	bar = None
+	if progress or callback:
+		bar = Progress(size, state['received'], style if progress else None, callback)
+	last_received = state['received']
+	tune_time, tune_received = time.time(), last_received
+	best_speed = 0
+	tuning = not segments
+	while any(t.is_alive() for t in workers):
+		time.sleep(0.2)
+		received = state['received']
+		if bar:
+			bar.update(received - last_received)
+		last_received = received
+		if tuning and time.time() - tune_time >= 1:
+			speed = (received - tune_received) / (time.time() - tune_time)
+			tune_time, tune_received = time.time(), received
+			if speed > best_speed * 1.1 and len(workers) < max_workers and \
+					not blocks.empty():
+				best_speed = speed
+				start_worker()
+			else:
+				tuning = False
+	if bar:
+		bar.finish()
+	if state['error']:
+		raise state['error']
+	print('{} connections'.format(len(workers)))
+	os.remove(part_path)
+
+
+# already compressed formats, deflating them only costs CPU
+stored_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.heic', '.webp', '.mp4',
+						'.mov', '.m4v', '.mkv', '.webm', '.mp3', '.m4a', '.aac', '.ogg',
+						'.flac', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+						'.jar', '.apk', '.ipa', '.docx', '.xlsx', '.pptx')
+
+# profile: [(minimum file size, deflate level), ...] checked in order
+compression_profiles = {
+	'fast': [(16 * 1024 * 1024, 1), (1024 * 1024, 3), (0, 6)],
+	'small': [(64 * 1024 * 1024, 6), (0, 9)],
+}
+
+
+def compression_policy(path, size, profile='fast', data=None):
+	'''Return (compress_type, compresslevel) for one file.
+
+	Known compressed formats and files whose 64 KB sample does not shrink
+	are stored, the others get a deflate level by size from the profile.
+	data is the content of path when it was read already.
+	'''
+	if os.path.splitext(path)[1].lower() in stored_extensions or size < 64:
+		return zipfile.ZIP_STORED, None
+	if size >= 64 * 1024:
+		start = size // 2 - 32 * 1024
+		if data is not None:
+			sample = data[start:start + 64 * 1024]
+		else:
+			with open(path, 'rb') as f:
+				f.seek(start)
+				sample = f.read(64 * 1024)
+		if len(zlib.compress(sample, 1)) > len(sample) * 0.95:
+			return zipfile.ZIP_STORED, None
+	for min_size, level in compression_profiles[profile]:
+		if size >= min_size:
+			return zipfile.ZIP_DEFLATED, level
+
 
-		if total_length is None:  # no content length header
-			f.write(response.content)
+def cpu_count():
+	try:
+		return os.cpu_count() or 2
+	except AttributeError:  # Python 2
+		return 2
+
+
+def ordered_map(func, items, workers=None, window=None):
+	'''Yield func(item) for every item in order, computed by worker threads
+	with at most `window` items in flight'''
+	workers = workers or cpu_count()
+	window = window or workers * 2
+	tasks = queue.Queue()
+	pending = collections.deque()
+
+	def worker():
+		while True:
+			slot = tasks.get()
+			if slot is None:
+				return
+			try:
+				slot['result'] = func(slot['item'])
+			except Exception as e:
+				slot['error'] = e
+			slot['event'].set()
+
+	def pop():
+		slot = pending.popleft()
+		slot['event'].wait()
+		if 'error' in slot:
+			raise slot['error']
+		return slot['result']
+
+	threads = []
+	for _ in range(workers):
+		t = threading.Thread(target=worker, name='Worker')
+		t.daemon = True
+		t.start()
+		threads.append(t)
+	try:
+		for item in items:
+			slot = {'item': item, 'event': threading.Event()}
+			pending.append(slot)
+			tasks.put(slot)
+			if len(pending) >= window:
+				yield pop()
+		while pending:
+			yield pop()
+	finally:
+		for _ in threads:
+			tasks.put(None)
+
+
+def normalize_arcname(arcname):
+	'''The member name ZipFile.write() stores for arcname'''
+	arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+	while arcname[0] in (os.sep, os.altsep):
+		arcname = arcname[1:]
+	return arcname.replace(os.sep, '/')
+
+
+def new_hash():
+	try:
+		return hashlib.blake2b(digest_size=20)
+	except AttributeError:  # Python < 3.6
+		return hashlib.sha1()
+
+
+def file_hash(path):
+	h = new_hash()
+	with open(path, 'rb') as f:
+		for data in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(data)
+	return h.hexdigest()
+
+
+def cached_hash(path, st, cache):
+	'''file_hash() of path, reused from cache while size and mtime match'''
+	entry = cache.get(path)
+	if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+		return entry[2]
+	digest = file_hash(path)
+	cache[path] = [st.st_size, st.st_mtime, digest]
+	return digest
+
+
+# files from this size are split into content defined chunks for dedup
+dedup_min_size = 1024 * 1024
+chunk_min_size = 64 * 1024
+chunk_max_size = 1024 * 1024
+chunk_scan_size = 64 * 1024  # bytes hashed at a time while looking for a cut
+# bytes per second iter_chunks() splits on a desktop CPU, assumed until the
+# receiver measured its own; the big int trick of gear_cut() is no match for C
+chunk_rate = 15 * 1024 * 1024
+chunk_store_limit = 1024 * 1024 * 1024
+recipe_extra_id = 0x7443  # extra field of members that are chunk recipes
+
+
+# gear hash: h = (h << 1) + gear_table[byte] mod 2**32, so h depends on the
+# last 32 bytes only and a cut point on nothing but the data around it
+gear_table = [struct.unpack('<I', hashlib.md5(struct.pack('<B', value)).digest()[:4])[0]
+				for value in range(256)]
+# byte j of every gear_table entry, for bytes.translate()
+gear_bytes = [bytes(bytearray((x >> 8 * j) & 0xFF for x in gear_table)) for j in range(4)]
+
+
+def gear_cut(data, start, end):
+	'''The first offset p in start < p <= end where the gear hash of the 32
+	bytes before p has its upper 16 bits zero (one in 64 KB), or None.
+
+	The hash of every position is computed at once: each byte's table entry
+	gets a 64 bit slot of one big int, and adding it to itself shifted by
+	one slot and one bit, then two, four, eight and sixteen, sums the 32
+	shifted entries of each window without carries between the slots.
+	Python 3 only, like everything that uses chunks.'''
+	begin = max(start - 31, 0)
+	window = data[begin:end]
+	n = len(window)
+	slots = bytearray(8 * n)
+	for j, table in enumerate(gear_bytes):
+		slots[j::8] = window.translate(table)
+	h = int.from_bytes(bytes(slots), 'little')
+	for shift in (65, 130, 260, 520, 1040):
+		h += h << shift
+	hashes = (h & ((1 << 64 * n) - 1)).to_bytes(8 * n, 'little')
+	high, low = hashes[3::8], hashes[2::8]
+	index = high.find(b'\0', start - begin)
+	while index >= 0:
+		if not low[index]:
+			return begin + index + 1
+		index = high.find(b'\0', index + 1)
+	return None
+
+
+def iter_chunks(f):
+	'''Split f where gear_cut() finds a cut point past chunk_min_size, or at
+	chunk_max_size. Cut points depend on the content only, so the chunks
+	after an inserted or removed run of bytes are the same as before.'''
+	buf = b''
+	eof = False
+	while buf or not eof:
+		if not eof and len(buf) < chunk_max_size:
+			data = f.read(chunk_max_size)
+			eof = not data
+			buf += data
+			continue
+		end = None
+		limit = min(len(buf), chunk_max_size)
+		for offset in range(chunk_min_size, limit, chunk_scan_size):
+			end = gear_cut(buf, offset, min(offset + chunk_scan_size, limit))
+			if end:
+				break
+		end = end or limit
+		yield buf[:end]
+		buf = buf[end:]
+
+
+def file_chunks(path):
+	'''([(digest, length), ...], file digest) of the chunks of path'''
+	h = new_hash()
+	index = []
+	with open(path, 'rb') as f:
+		for data in iter_chunks(f):
+			h.update(data)
+			index.append((chunk_digest(data), len(data)))
+	return index, h.hexdigest()
+
+
+def cached_chunks(path, st, cache):
+	'''file_chunks() of path, reused from cache while size and mtime match'''
+	entry = cache.get(path)
+	if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+		return entry[3], entry[2]
+	index, digest = file_chunks(path)
+	cache[path] = [st.st_size, st.st_mtime, digest, index]
+	return index, digest
+
+
+def chunk_signature(index):
+	'''{digest: (offset, length)} of the chunks in index, see file_chunks()'''
+	signature = {}
+	offset = 0
+	for digest, length in index:
+		signature.setdefault(digest, (offset, length))
+		offset += length
+	return signature
+
+
+def chunk_digest(data):
+	h = new_hash()
+	h.update(data)
+	return h.hexdigest()
+
+
+class Chunk_Store(object):
+	'''Chunks named by their digest. The least recently used are evicted
+	once the store grows past limit bytes.'''
+	def __init__(self, path, limit=chunk_store_limit):
+		self.path = path
+		self.limit = limit
+
+	def chunk_path(self, digest):
+		return os.path.join(self.path, digest)
+
+	def has(self, digest):
+		return os.path.isfile(self.chunk_path(digest))
+
+	def get(self, digest):
+		path = self.chunk_path(digest)
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+		except IOError:
+			return None
+		os.utime(path, None)  # mtime is the last use
+		return data
+
+	def put(self, digest, data):
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+		path = self.chunk_path(digest)
+		with open(path + '.tmp', 'wb') as f:
+			f.write(data)
+		if os.path.exists(path):
+			os.remove(path)
+		os.rename(path + '.tmp', path)
+
+	def evict(self):
+		if not os.path.isdir(self.path):
+			return
+		chunks = [(st.st_mtime, st.st_size, path) for name, path, st
+					in scan_dir(self.path)]
+		total = sum(size for mtime, size, path in chunks)
+		for mtime, size, path in sorted(chunks):
+			if total <= self.limit:
+				break
+			os.remove(path)
+			total -= size
+
+
+def member_info(path, arcname, st=None):
+	'''ZipInfo for path the way ZipFile.write() builds it'''
+	st = st or os.stat(path)
+	arcname = normalize_arcname(arcname)
+	date_time = max(time.localtime(st.st_mtime)[0:6], (1980, 1, 1, 0, 0, 0))
+	zinfo = zipfile.ZipInfo(arcname, date_time)
+	zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+	return zinfo
+
+
+# compress_member() output is appended through ZipFile internals that
+# CPython has had since 2.7, without them writestr() compresses instead
+raw_members_supported = hasattr(zipfile.ZipFile, '_writecheck') and \
+	hasattr(zipfile.ZipInfo, 'FileHeader')
+
+
+def set_compress_level(zinfo, level):
+	'''Deflate level ZipFile.open(zinfo, "w") uses, public as compress_level
+	since Python 3.13 and ignored before 3.7'''
+	if hasattr(zinfo, 'compress_level'):
+		zinfo.compress_level = level
+	else:
+		zinfo._compresslevel = level
+
+
+def read_file(path):
+	with open(path, 'rb') as f:
+		return f.read()
+
+
+def compress_member(path, arcname, compress_type, level, st=None, data=None):
+	'''Hash and compress one file, read unless data holds it already.
+	Returns (zinfo, data, digest, level), data is compressed and level None
+	where raw_members_supported, see write_compressed()'''
+	zinfo = member_info(path, arcname, st)
+	if data is None:
+		data = read_file(path)
+	h = new_hash()
+	h.update(data)
+	zinfo.file_size = len(data)
+	zinfo.CRC = zlib.crc32(data) & 0xFFFFFFFF
+	zinfo.compress_type = compress_type
+	if not raw_members_supported:
+		return zinfo, data, h.hexdigest(), level
+	if compress_type == zipfile.ZIP_DEFLATED:
+		compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED,
+										-15)
+		data = compressor.compress(data) + compressor.flush()
+	zinfo.compress_size = len(data)
+	return zinfo, data, h.hexdigest(), None
+
+
+def write_compressed(zf, zinfo, data, level=None):
+	'''Append a member from compress_member() to zf'''
+	if not raw_members_supported:
+		if sys.version_info >= (3, 7):
+			zf.writestr(zinfo, data, compresslevel=level)
 		else:
-			dl = 0
-			total_length = int(total_length)
-			dl_time = time.time()
-			dl_speed = 0
-			dl_size_per_sec = 0
-			one_sec_passed = False
-			eta = 0
-			for data in response.iter_content(chunk_size=int(total_length / 100)):
-				dl += len(data)
-				f.write(data)
-				done = int(50 * dl / total_length)
-				percent = int(100 * dl / total_length)
-				dl_size_per_sec += len(data)
-				if time.time() - dl_time >= 1:
-					# to get dl speed
-					dl_time = time.time()
-					dl_speed = human_size(dl_size_per_sec)
-					eta = (total_length - dl) / dl_size_per_sec
-					dl_size_per_sec = 0
-					one_sec_passed = True
-
-				eta_min = int(eta / 60)
-				eta_sec = int(eta % 60)
-				if eta_min == 0 and eta_sec == 0:
-					eta_text = "∞"
-				else:
-					eta_text = "{:02}:{:02}".format(eta_min, eta_sec)
-				if percent == 100:
-					eta_text = "00:00"
-				if progress:
-					if style == 1:
-						fmt = "\r[{}{}]{} {}% {}/s {} "
-						sys.stdout.write(fmt.format('=' * done, ' ' * (50 - done),
-													human_size(total_length), percent,
-													dl_speed if one_sec_passed else human_size(dl_size_per_sec),
-													eta_text))
-					if style == 2:
-						fmt = "\r{}/{} {}％ {}/s {} "
-						sys.stdout.write(fmt.format(human_size(dl, True),
-													human_size(total_length), percent,
-													dl_speed if one_sec_passed else human_size(dl_size_per_sec),
-													eta_text))
-					sys.stdout.flush()
-
-
-def archiver(files, hide=False, to_path=False, comment=None):
+			zf.writestr(zinfo, data)
+		return
+	zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+		zinfo.compress_size > zipfile.ZIP64_LIMIT
+	if getattr(zf, '_seekable', False):
+		zf.fp.seek(zf.start_dir)
+	zinfo.header_offset = zf.fp.tell()
+	zf._writecheck(zinfo)
+	zf._didModify = True
+	zf.fp.write(zinfo.FileHeader(zip64))
+	zf.fp.write(data)
+	zf.filelist.append(zinfo)
+	zf.NameToInfo[zinfo.filename] = zinfo
+	if hasattr(zf, 'start_dir'):  # Python 3 writes the central directory there
+		zf.start_dir = zf.fp.tell()
+
+
+def write_member(zf, path, arcname, st, compress_type, level):
+	'''Stream a large file into zf, hashing it in the same read. Returns
+	its digest, None where ZipFile.open() cannot write (Python < 3.6).'''
+	if not dedup_supported:
+		if sys.version_info >= (3, 7):
+			zf.write(path, arcname, compress_type, level)
+		else:
+			zf.write(path, arcname, compress_type)
+		return None
+	zinfo = member_info(path, arcname, st)
+	zinfo.compress_type = compress_type
+	set_compress_level(zinfo, level)
+	zinfo.file_size = st.st_size  # only decides ZIP64
+	h = new_hash()
+	with open(path, 'rb') as f, zf.open(zinfo, 'w') as member:
+		for data in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(data)
+			member.write(data)
+	return h.hexdigest()
+
+
+def write_recipe(zf, path, arcname, st, index, have, level, sent=None):
+	'''Write path as a recipe member: records of (kind, digest, length),
+	chunks in have or sent are referenced (kind 0), the others follow their
+	record (kind 1) and are added to sent, the chunks earlier members of
+	the archive carried to the receiver's store. Deflated so that a stream
+	stays self-delimiting.'''
+	zinfo = member_info(path, arcname, st)
+	zinfo.compress_type = zipfile.ZIP_DEFLATED
+	set_compress_level(zinfo, level)
+	zinfo.extra = struct.pack('<HH', recipe_extra_id, 0)
+	zinfo.file_size = st.st_size  # only decides ZIP64
+	with open(path, 'rb') as f, zf.open(zinfo, 'w') as member:
+		for digest, length in index:
+			if digest in have or sent is not None and digest in sent:
+				member.write(Recipe_Writer.record.pack(0, digest.encode('ascii'), length))
+				f.seek(length, 1)
+			else:
+				member.write(Recipe_Writer.record.pack(1, digest.encode('ascii'), length))
+				member.write(f.read(length))
+				if sent is not None:
+					sent.add(digest)
+
+
+# written last, {'hash': hash name, 'files': {member name: digest}}
+hashes_member = '.transfer-hashes.json'
+
+# members up to this size are read and compressed by the worker threads
+parallel_member_limit = 4 * 1024 * 1024
+
+
+def archiver(files, hide=False, to_path=False, comment=None, profile='fast',
+				include=None, exclude=None, hidden=False, select=None, dedup=None,
+				verify=True):
+	'''Files up to parallel_member_limit are compressed by a thread pool (zlib
+	releases the GIL) and appended in order, larger ones are streamed through
+	ZipFile.write(). Members come straight from walk_files(), select(path,
+	stat, arcname) can leave some out. dedup is (chunk_index(path, stat),
+	held(arcname), sent), large files become recipes of the chunks the
+	receiver holds unless held() returns None, sent is a set of the chunks
+	already in the archive for a receiver that stores them, or None. The
+	digest of every file, taken in the read that compresses it, goes into
+	the hashes_member at the end unless verify is False.'''
 	if not to_path:
 		to_path = os.path.basename(files[0]) + '.zip'
-	file_list = search_all_file(files)
-	path_pat = re.compile('.+?Documents')
-	path_arcname_list = [[x, path_pat.sub("", x)] for x in file_list]
+	# stored members of a stream need their size up front, deflate level 0
+	# keeps large ones cheap and self-delimiting instead
+	streaming = hasattr(to_path, 'write')
+	entries = walk_files(files, include, exclude, hidden)
+	head = list(itertools.islice(entries, 2))
+	single = not pythonista and len(head) == 1
+	entries = itertools.chain(head, entries)
+
+	def prepare(entry):
+		path, st, arcname = entry
+		if single:
+			arcname = os.path.basename(path)
+		if select and not select(path, st, arcname):
+			return None
+		if stat.S_ISDIR(st.st_mode):
+			return path, arcname, None
+		size = st.st_size
+		have = dedup[1](arcname) if dedup and size >= dedup_min_size else None
+		# small files are read once, for the sample and the member
+		data = read_file(path) if have is None and size <= parallel_member_limit \
+			else None
+		compress_type, level = compression_policy(path, size, profile, data)
+		if have is not None:
+			level = 0 if compress_type == zipfile.ZIP_STORED else level
+			index, digest = dedup[0](path, st)
+			return path, arcname, ('recipe', st, index, have, level, digest)
+		if data is not None:
+			if streaming and compress_type == zipfile.ZIP_STORED and \
+					not raw_members_supported:
+				# writestr() gives stored members of a stream a data descriptor
+				compress_type, level = zipfile.ZIP_DEFLATED, 0
+			member = compress_member(path, arcname, compress_type, level, st, data)
+			return path, arcname, member
+		if streaming and compress_type == zipfile.ZIP_STORED:
+			compress_type, level = zipfile.ZIP_DEFLATED, 0
+		return path, arcname, (st, compress_type, level)
+
+	hashes = {}
 	with zipfile.ZipFile(to_path, "w", zipfile.ZIP_DEFLATED,
 							allowZip64=True) as zf:
 		if comment:
 			zf.comment = comment.encode('utf-8')
-		for path, arcname in path_arcname_list:
-			if not pythonista and len(file_list) == 1:
-				arcname = os.path.basename(path)
+		for prepared in ordered_map(prepare, entries):
+			if prepared is None:
+				continue
+			path, arcname, member = prepared
 			if not hide:
 				print("adding " + arcname)
-			zf.write(path, arcname)
+			if member is None:
+				zf.write(path, arcname)
+				continue
+			if isinstance(member[0], zipfile.ZipInfo):
+				zinfo, data, digest, level = member
+				write_compressed(zf, zinfo, data, level)
+			elif member[0] == 'recipe':
+				kind, st, index, have, level, digest = member
+				write_recipe(zf, path, arcname, st, index, have, level, dedup[2])
+			else:
+				digest = write_member(zf, path, arcname, *member)
+			if digest:
+				hashes[normalize_arcname(arcname)] = digest
+		if hashes and verify:
+			zf.writestr(hashes_member, json.dumps({'hash': new_hash().name,
+													'files': hashes}))
 
 		'''for _ in zf.infolist():
 			_.comment = _.filename.encode('utf-8')#encode('shift-jis', 'replace')'''
 
 
+def pop_option(args, name, default=None):
+	'''Remove "name value" from args and return value'''
+	if name in args:
+		index = args.index(name)
+		value = args[index + 1]
+		del args[index:index + 2]
+		return value
+	return default
+
+
 def select():
 	result = console.alert("", "Select", "Send", "Receive", 'Cancel',
 							hide_cancel_button=True)
@@ -840,10 +3773,20 @@ def get_selected_text():
 
 
 def start_up():
-	'''always receive mode'''
+	'''always receive mode, idle until a sender announces itself'''
 	def _start_up():
+		delay = wait_interval
 		while True:
-			transfer.receive(wait_interval, False)
+			try:
+				transfer.receive(wait_interval, False, standing=True)
+			except Exception as e:
+				# e.g. the last beacon of a sender that has stopped, keep standing by
+				print('Error while receiving')
+				print(e)
+				time.sleep(delay)
+				delay = min(delay * 2, standing_poll_max)
+			else:
+				delay = wait_interval
 	console.hide_output()
 	print('Ready to receive.....')
 	threading.Thread(target=_start_up, name='Transfer_Startup').start()
@@ -852,6 +3795,9 @@ def start_up():
 main_dir = "Transfer"
 port = 8765
 wait_interval = 1  # sec multiply this value if something error happened
+# scan intervals of a standing receiver that hears no beacon, see wait_sender()
+standing_poll_min = 2
+standing_poll_max = 120
 
 main_dir = to_abs_path(main_dir)
 if not os.path.isdir(main_dir):
@@ -863,6 +3809,37 @@ port_scan = Port_Scan(port, False)
 if __name__ == '__main__':
 	args = sys.argv
 	user_args = args[1:]
+	# Transfer.py --receivers 12 --deadline 600 file1 file2
+	receivers = int(pop_option(user_args, '--receivers', 1))
+	deadline = pop_option(user_args, '--deadline')
+	deadline = float(deadline) if deadline else None
+	transfer.segments = int(pop_option(user_args, '--segments', 0))
+	profile = pop_option(user_args, '--profile', 'fast')  # fast or small
+	if profile not in compression_profiles:
+		sys.exit('Unknown profile {}, use one of: {}'.format(
+			profile, ', '.join(sorted(compression_profiles))))
+	# --include '*.py,*.pyui' --exclude 'node_modules,*.pyc' --hidden yes
+	for option in ('include', 'exclude'):
+		patterns = pop_option(user_args, '--' + option)
+		if patterns:
+			transfer.walk_options[option] = patterns.split(',')
+	transfer.walk_options['hidden'] = pop_option(user_args, '--hidden') == 'yes'
+	transfer.dedup = pop_option(user_args, '--dedup') == 'yes'
+	transfer.native = pop_option(user_args, '--native', 'yes') == 'yes'
+	# --sync yes sends only what differs from the receiver's copy, --delete yes
+	# also removes there what is gone here, see Transfer.sync(). Pythonista only
+	sync = pop_option(user_args, '--sync') == 'yes'
+	delete = pop_option(user_args, '--delete') == 'yes'
+	if delete and not sync:
+		sys.exit('--delete needs --sync yes')
+	# --rate 10M --client-rate 2M, see also "/rate" while serving
+	for option, attr in (('--rate', 'rate_limit'), ('--client-rate', 'client_rate_limit')):
+		value = pop_option(user_args, option)
+		try:
+			setattr(transfer, attr, parse_size(value))
+		except ValueError:
+			sys.exit('{} takes a size above 0 like 500K, 10M or 1.5G, not {}'.format(
+				option, value))
 	if pythonista:
 		# Pythonista
 		if sys.version[0] == '3' and appex.is_widget():
@@ -870,10 +3847,15 @@ if __name__ == '__main__':
 		elif 'select' in user_args:
 			select()
 		elif 'send' in user_args:
-			files = file_picker('Pick files', multiple=True, select_dirs=True,
-								file_pattern=r'^.+$')
+			files = file_picker()('Pick files', multiple=True, select_dirs=True,
+									file_pattern=r'^.+$')
 			if files:
 				transfer.send(files)
+		elif 'sync' in user_args:
+			files = file_picker()('Pick files', multiple=True, select_dirs=True,
+									file_pattern=r'^.+$')
+			if files:
+				transfer.sync(files, delete=delete or 'delete' in user_args)
 		elif 'receive' in user_args:
 			transfer.receive(wait_interval)
 		elif 'send_selected_or_clipboard_text' in user_args:
@@ -881,10 +3863,15 @@ if __name__ == '__main__':
 			if not share_text:
 				share_text = clipboard.get()
 			transfer.send_text(share_text)
+		elif user_args and sync:
+			files = user_args
+			print(files)
+			transfer.sync(files, delete=delete, deadline=deadline, profile=profile)
 		elif user_args:
 			files = user_args
 			print(files)
-			transfer.send(files)
+			transfer.send(files, receivers=receivers, deadline=deadline,
+							profile=profile)
 		else:
 			if appex.is_running_extension():
 				path = appex.get_file_paths()
@@ -900,7 +3887,7 @@ if __name__ == '__main__':
 											hide_cancel_button=True) == 2:
 							transfer.send_text(share_text)
 					else:
-						transfer.send(path)
+						transfer.send(path, stream=True)
 			else:
 				share_text = get_selected_text()
 				if share_text:
@@ -912,10 +3899,15 @@ if __name__ == '__main__':
 					select()
 	else:
 		# PC
+		if sync:
+			# only files of a Pythonista sender are placed at their original
+			# paths, the files of others have no copy to compare with
+			sys.exit('--sync needs Pythonista on both ends')
 		if user_args:
 			files = user_args
 			print(files)
-			transfer.send(files)
+			transfer.send(files, stream=True, receivers=receivers, deadline=deadline,
+							profile=profile)
 		else:
 			print('Working Dir {}'.format(main_dir))
 			print('1 : Send file\n2 : Receive file/text\n3 : Share text')
@@ -924,7 +3916,7 @@ if __name__ == '__main__':
 				print('You can also use Transfer.py file1 file2 file3...')
 				print('Path>>')
 				path = input().strip().strip("'").strip('"')
-				transfer.send([path])
+				transfer.send([path], stream=True, profile=profile)
 			elif result == '2':
 				transfer.receive(wait_interval, True)
 			elif result == '3':